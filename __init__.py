@@ -12,5 +12,7 @@ def register():
         product.Product,
         product.ProductKitLine,
         invoice.InvoiceLine,
+        sale.Configuration,
+        sale.Sale,
         sale.SaleLine,
         module='sale_kit', type_='model')
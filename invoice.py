@@ -1,7 +1,9 @@
 # This file is part of sale_kit module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+
+from .tools import zero_base_taxes
 
 __all__ = ['InvoiceLine']
 
@@ -13,3 +15,15 @@ class InvoiceLine(metaclass=PoolMeta):
     def __setup__(cls):
         super(InvoiceLine, cls).__setup__()
         cls.unit_price.states['required'] = False
+
+    @property
+    def taxable_lines(self):
+        # The kit lines without price do not change the taxes of the invoice
+        SaleLine = Pool().get('sale.line')
+        origin = getattr(self, 'origin', None)
+        if (isinstance(origin, SaleLine)
+                and getattr(self, 'unit_price', None) == 0
+                and origin.zero_priced_kit_line
+                and zero_base_taxes(getattr(self, 'taxes', None) or [])):
+            return []
+        return super(InvoiceLine, self).taxable_lines
@@ -1,24 +1,49 @@
 # This file is part of sale_kit module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict, namedtuple
 from decimal import Decimal
+from itertools import chain
 
+from trytond.cache import Cache, freeze
 from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Bool
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
 from trytond.i18n import gettext
-from trytond.model.exceptions import ValidationError
+from trytond.model.exceptions import RecursionError, ValidationError
+
+from .tools import current_profile, phase, profiled, transaction_memo
 
 STATES = {
     'invisible': Bool(~Eval('kit')),
 }
 DEPENDS = ['kit']
+KIT_FIELDS = {
+    'kit', 'kit_lines', 'explode_kit_in_sales', 'kit_fixed_list_price'}
+
+# A component of the flattened kit tree of a product:
+#   kit_line: id of the product.kit.line
+#   product: id of the component product
+#   quantity: quantity of the component for each unit of the kit
+#   unit, unit_category: ids of the unit of the kit line and its category
+#   depth: depth of the component in the kit tree (1 for the first level)
+#   priced: if the component must be priced when the kit is exploded
+KitComponent = namedtuple('KitComponent', [
+        'kit_line', 'product', 'quantity', 'unit', 'unit_category', 'depth',
+        'priced'])
 
 
 class Product(metaclass=PoolMeta):
     __name__ = "product.product"
     explode_kit_in_sales = fields.Boolean('Explode in Sales', states=STATES)
+    kit_buildable_quantity = fields.Function(fields.Float(
+            'Buildable Quantity', digits='default_uom', states=STATES,
+            help='The number of kits that can be assembled from the stock '
+            'of their components in the locations of the context.'),
+        'get_kit_buildable_quantity')
+    _kit_plan_cache = Cache('product.product.kit_plan', context=False)
 
     @staticmethod
     def default_explode_kit_in_sales():
@@ -28,114 +53,381 @@ class Product(metaclass=PoolMeta):
     def default_kit_fixed_list_price():
         return True
 
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        if any(KIT_FIELDS & set(values)
+                for _, values in zip(actions, actions)):
+            cls._kit_plan_cache.clear()
+        super(Product, cls).write(*args)
+
+    @classmethod
+    def delete(cls, products):
+        cls._kit_plan_cache.clear()
+        super(Product, cls).delete(products)
+
+    @classmethod
+    def get_kit_plans(cls, products):
+        '''
+        Return a dictionary with the flattened kit tree of each product as a
+        list of KitComponent sorted in depth-first order.
+        '''
+        plans = {}
+        for product in products:
+            plan = cls._kit_plan_cache.get(product.id)
+            if plan is None:
+                plan = cls._kit_plan_cache.set(
+                    product.id, product._get_kit_plan())
+            plans[product.id] = plan
+        return plans
+
+    def get_kit_plan(self):
+        return self.get_kit_plans([self])[self.id]
+
+    @property
+    def kit_exploded_in_sales(self):
+        "If the product is a kit with components exploded in sales"
+        return bool(self.kit and self.kit_lines and self.explode_kit_in_sales)
+
+    def _get_kit_plan(self):
+        KitLine = Pool().get('product.kit.line')
+
+        kit_lines = []
+        stack = [(line, 1) for line in reversed(self.kit_lines)]
+        while stack:
+            kit_line, depth = stack.pop()
+            kit_lines.append((kit_line, depth))
+            product = kit_line.product
+            if product.kit and product.kit_lines:
+                stack.extend((line, depth + 1)
+                    for line in reversed(product.kit_lines))
+
+        priced = KitLine.get_lines_sale_price(
+            [kit_line for kit_line, _ in kit_lines])
+        return [KitComponent(
+                kit_line=kit_line.id,
+                product=kit_line.product.id,
+                quantity=kit_line.quantity,
+                unit=kit_line.unit.id,
+                unit_category=kit_line.unit.category.id,
+                depth=depth,
+                priced=priced[kit_line.id],
+                ) for kit_line, depth in kit_lines]
+
+    def _get_kit_component_needs(self):
+        '''
+        Return a dictionary with the quantity in its default unit of each
+        component product that is not a kit needed for one unit of the kit.
+        '''
+        pool = Pool()
+        Uom = pool.get('product.uom')
+
+        needs = defaultdict(float)
+        factors = [1]
+        for component in self.get_kit_plan():
+            product = self.__class__(component.product)
+            quantity = component.quantity
+            if component.unit_category == product.default_uom.category.id:
+                quantity = Uom.compute_qty(Uom(component.unit), quantity,
+                    product.default_uom, round=False)
+            del factors[component.depth:]
+            factors.append(factors[-1] * quantity)
+            if not (product.kit and product.kit_lines):
+                needs[product.id] += factors[-1]
+        return needs
+
+    @classmethod
+    def get_kit_buildable_quantities(cls, products, location_ids):
+        '''
+        Return a dictionary with the number of kits of each product that can
+        be assembled from the stock of their components in each location,
+        keyed by location and product id.
+        The stock of all the components is computed with a single
+        products_by_location call and the result is memoized for the
+        transaction.
+        '''
+        memo = transaction_memo('product.product.kit_buildable_quantity')
+        memo = memo.setdefault(freeze(Transaction().context), {})
+        todo = [p for p in products if p.kit and p.kit_lines
+            and any((location_id, p.id) not in memo
+                for location_id in location_ids)]
+        if todo:
+            needs = {p.id: p._get_kit_component_needs() for p in todo}
+            product_ids = set(chain(*needs.values()))
+            quantities = cls.products_by_location(location_ids,
+                with_childs=True, grouping_filter=(list(product_ids),))
+            stockables = {p.id for p in cls.browse(product_ids)
+                if p.type == 'goods'}
+            for location_id in location_ids:
+                for kit_id, kit_needs in needs.items():
+                    buildable = None
+                    for product_id, need in kit_needs.items():
+                        if product_id not in stockables or need <= 0:
+                            continue
+                        quantity = max(quantities.get(
+                                (location_id, product_id), 0), 0)
+                        quantity = quantity // need
+                        if buildable is None or quantity < buildable:
+                            buildable = quantity
+                    memo[(location_id, kit_id)] = buildable
+        return {(location_id, p.id): memo.get((location_id, p.id))
+            for location_id in location_ids for p in products}
+
+    @classmethod
+    def get_kit_buildable_quantity(cls, products, name):
+        location_ids = Transaction().context.get('locations') or []
+        quantities = cls.get_kit_buildable_quantities(products, location_ids)
+        result = {}
+        for product in products:
+            values = [quantities[(location_id, product.id)]
+                for location_id in location_ids]
+            values = [v for v in values if v is not None]
+            result[product.id] = sum(values) if values else None
+        return result
+
     @classmethod
     def validate(cls, products):
         super(Product, cls).validate(products)
-        for product in products:
-            product.check_required_salable_products_in_kits()
+        cls.check_kits_required_salable_products(products)
 
     def check_required_salable_products_in_kits(self):
-        KitLine = Pool().get('product.kit.line')
+        self.check_kits_required_salable_products([self])
 
-        if not self.kit:
-            return
+    @classmethod
+    def check_kits_required_salable_products(cls, products):
+        '''
+        Check the kits exploded in sales of the products have only salable
+        components. Their kit lines are searched at once.
+        '''
+        KitLine = Pool().get('product.kit.line')
 
-        n_not_salable_lines = KitLine.search_count([
-                ('parent', 'in', [self.id]),
-                ('product.salable', '=', False),
-                ('parent.explode_kit_in_sales', '=', True),
-                ])
-        if n_not_salable_lines:
-            raise ValidationError(gettext('sale_kit.salable_product_required_in_kit',
-                product=self.rec_name))
+        kits = [p for p in products if p.kit]
+        invalid = set()
+        for sub_kits in grouped_slice(kits):
+            lines = KitLine.search([
+                    ('parent', 'in', [p.id for p in sub_kits]),
+                    ('product.salable', '=', False),
+                    ('parent.explode_kit_in_sales', '=', True),
+                    ])
+            invalid.update(line.parent.id for line in lines)
+        for product in kits:
+            if product.id in invalid:
+                raise ValidationError(gettext(
+                        'sale_kit.salable_product_required_in_kit',
+                        product=product.rec_name))
 
     @classmethod
+    @profiled('product.product.get_sale_price')
     def get_sale_price(cls, products, quantity=0):
         '''
         Return the sale price for products and quantity.
         It uses if exists from the context:
             uom: the unit of measure
             currency: the currency id for the returned price
+        The prices are memoized for the transaction by context and quantity.
         '''
-        pool = Pool()
-        Uom = pool.get('product.uom')
-        User = pool.get('res.user')
-        Currency = pool.get('currency.currency')
-        Date = pool.get('ir.date')
-
-        today = Date.today()
+        memo = transaction_memo('product.product.sale_price').setdefault(
+            (freeze(Transaction().context), quantity), {})
         prices = {}
-
-        uom = None
-        if Transaction().context.get('uom'):
-            uom = Uom(Transaction().context.get('uom'))
-
-        currency = None
-        if Transaction().context.get('currency'):
-            currency = Currency(Transaction().context.get('currency'))
-
-        user = User(Transaction().user)
-
         todo_products = set()
+        kits = []
         for product in products:
+            if product.id in memo:
+                prices[product.id] = memo[product.id]
+                continue
             if not product.kit or product.kit_fixed_list_price:
                 todo_products.add(product)
                 continue
             if product.explode_kit_in_sales:
                 prices[product.id] = Decimal(0)
                 continue
+            kits.append(product)
 
-            product_price = Decimal(0)
-            for kit_line in product.kit_lines:
-                with Transaction().set_context(uom=kit_line.unit):
-                    price = cls.get_sale_price([kit_line.product],
-                            quantity=kit_line.quantity)[kit_line.product.id]
-                    if price:
-                        price *= Decimal(str(kit_line.quantity))
-                        product_price += price
-            prices[product.id] = product_price
+        profile = current_profile()
+        if profile and profile.name == 'product.product.get_sale_price':
+            profile.tags.update(products=len(products),
+                kits=sorted(product.id for product in kits),
+                memoized=len([p for p in products if p.id in memo]))
 
-            if uom:
-                prices[product.id] = Uom.compute_price(
-                    product.default_uom, prices[product.id], uom)
-            if currency and user.company:
-                if user.company.currency != currency:
-                    date = Transaction().context.get('sale_date') or today
-                    with Transaction().set_context(date=date):
-                        prices[product.id] = Currency.compute(
-                            user.company.currency, prices[product.id],
-                            currency, round=False)
+        if kits:
+            with phase('kit rollup'):
+                uom = Transaction().context.get('uom')
+                convert = cls._get_kit_price_converter()
+                totals = cls._get_kit_rollup_prices(kits, convert)
+                for product in kits:
+                    prices[product.id] = convert(
+                        product, totals[product.id], uom)
 
         if todo_products:
-            prices.update(super(Product, cls).get_sale_price(todo_products,
-                    quantity))
+            with phase('sale price'):
+                prices.update(super(Product, cls).get_sale_price(
+                        todo_products, quantity))
 
+        for product_id, price in prices.items():
+            if product_id is not None and product_id >= 0:
+                memo[product_id] = price
         return prices
 
+    @classmethod
+    def _get_kit_rollup_prices(cls, kits, convert):
+        '''
+        Return the sum of the sale prices of the components of the kits,
+        computed bottom-up for all the nested kits at once.
+        Each distinct component, unit and quantity is priced only once and
+        the price of the nested kits is converted with convert.
+        '''
+        def is_leaf(product):
+            return not product.kit or product.kit_fixed_list_price
+
+        ordered, done = [], set()
+        leaves = defaultdict(set)
+
+        def visit(kit, path):
+            if kit.id in path:
+                raise RecursionError(gettext('sale_kit.kit_recursion',
+                        product=kit.rec_name))
+            if kit.id in done:
+                return
+            path.add(kit.id)
+            for kit_line in kit.kit_lines:
+                product = kit_line.product
+                if is_leaf(product):
+                    leaves[(kit_line.unit.id, kit_line.quantity)].add(product)
+                elif not product.explode_kit_in_sales:
+                    visit(product, path)
+            path.remove(kit.id)
+            done.add(kit.id)
+            ordered.append(kit)
+
+        for kit in kits:
+            visit(kit, set())
+
+        leaf_prices = {}
+        for (unit, quantity), products in leaves.items():
+            with Transaction().set_context(uom=unit):
+                prices = cls.get_sale_price(list(products), quantity=quantity)
+            for product_id, price in prices.items():
+                leaf_prices[(product_id, unit, quantity)] = price
+
+        totals = {}
+        for kit in ordered:
+            total = Decimal(0)
+            for kit_line in kit.kit_lines:
+                product = kit_line.product
+                if is_leaf(product):
+                    price = leaf_prices[
+                        (product.id, kit_line.unit.id, kit_line.quantity)]
+                elif product.explode_kit_in_sales:
+                    price = Decimal(0)
+                else:
+                    price = convert(
+                        product, totals[product.id], kit_line.unit.id)
+                if price:
+                    total += price * Decimal(str(kit_line.quantity))
+            totals[kit.id] = total
+        return totals
+
+    @classmethod
+    def _get_kit_price_converter(cls):
+        '''
+        Return a function that converts the price of a kit from its default
+        unit and the company currency to a unit and the currency of the
+        context. The currency rates are read once for all the prices.
+        '''
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        User = pool.get('res.user')
+        Currency = pool.get('currency.currency')
+        Date = pool.get('ir.date')
+
+        context = Transaction().context
+        rates = None
+        user = User(Transaction().user)
+        if context.get('currency') and user.company:
+            company_currency = user.company.currency
+            if company_currency.id != int(context['currency']):
+                date = context.get('sale_date') or Date.today()
+                with Transaction().set_context(date=date):
+                    from_currency = Currency(company_currency.id)
+                    to_currency = Currency(int(context['currency']))
+                    if not from_currency.rate or not to_currency.rate:
+                        # Raise the missing rate error
+                        Currency.compute(from_currency, Decimal(0),
+                            to_currency, round=False)
+                    rates = (to_currency.rate, from_currency.rate)
+
+        uoms = {}
+
+        def convert(product, price, uom=None):
+            if uom:
+                uom = int(uom)
+                if uom not in uoms:
+                    uoms[uom] = Uom(uom)
+                price = Uom.compute_price(
+                    product.default_uom, price, uoms[uom])
+            if rates:
+                to_rate, from_rate = rates
+                price = price * to_rate / from_rate
+            return price
+        return convert
+
 
 class ProductKitLine(metaclass=PoolMeta):
     __name__ = 'product.kit.line'
 
+    @classmethod
+    def create(cls, vlist):
+        Product = Pool().get('product.product')
+        Product._kit_plan_cache.clear()
+        return super(ProductKitLine, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Product = Pool().get('product.product')
+        Product._kit_plan_cache.clear()
+        super(ProductKitLine, cls).write(*args)
+
+    @classmethod
+    def delete(cls, lines):
+        Product = Pool().get('product.product')
+        Product._kit_plan_cache.clear()
+        super(ProductKitLine, cls).delete(lines)
 
     def get_sale_price(self):
-        parent = self.parent
-        if parent.kit_fixed_list_price:
-            return False
-        parent_kit_lines = self.search([
-                ("product", "=", parent.id),
-                ])
-        for line in parent_kit_lines:
-            if line in [x for x in line.product.kit_lines]:
-                return line.get_sale_price()
-        return True
+        return self.get_lines_sale_price([self])[self.id]
+
+    @classmethod
+    def get_lines_sale_price(cls, lines):
+        '''
+        Return a dictionary with True for the lines whose product must be
+        priced when their kit is exploded in a sale.
+        The result is memoized for the transaction.
+        '''
+        memo = transaction_memo('product.kit.line.sale_price')
+        for line in lines:
+            if line.id not in memo:
+                memo[line.id] = not line.parent.kit_fixed_list_price
+        return {line.id: memo[line.id] for line in lines}
 
     @classmethod
     def validate(cls, lines):
         super(ProductKitLine, cls).validate(lines)
-        for line in lines:
-            line.check_required_salable_lines()
+        cls.check_lines_required_salable(lines)
 
     def check_required_salable_lines(self):
-        if (self.parent.explode_kit_in_sales and
-                not self.product.salable):
-            raise ValidationError(gettext('sale_kit.salable_lines_required'))
+        self.check_lines_required_salable([self])
+
+    @classmethod
+    def check_lines_required_salable(cls, lines):
+        '''
+        Check the lines of the kits exploded in sales have a salable product.
+        The lines are searched at once.
+        '''
+        for sub_lines in grouped_slice(lines):
+            if cls.search([
+                        ('id', 'in', [line.id for line in sub_lines]),
+                        ('parent.explode_kit_in_sales', '=', True),
+                        ('product.salable', '=', False),
+                        ], limit=1):
+                raise ValidationError(
+                    gettext('sale_kit.salable_lines_required'))
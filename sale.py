@@ -1,12 +1,166 @@
 # This file is part of sale_kit module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import defaultdict
 from decimal import Decimal
-from trytond.model import fields
+from itertools import chain
+
+from sql import Null, Window
+from sql.conditionals import Coalesce
+from sql.functions import RowNumber
+
+from trytond import config
+from trytond.cache import freeze, unfreeze
+from trytond.i18n import gettext
+from trytond.model import Index, fields
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Equal, Eval
+from trytond.tools import grouped_slice
 from trytond.transaction import Transaction
 from trytond.modules.product import round_price
+from trytond.modules.sale.exceptions import SaleQuotationError
+
+from .tools import (
+    current_profile, phase, profiled, transaction_memo, zero_base_taxes)
+
+
+class Configuration(metaclass=PoolMeta):
+    __name__ = 'sale.configuration'
+    kit_explosion_queue_threshold = fields.Integer(
+        "Kit Explosion Queue Threshold",
+        domain=['OR',
+            ('kit_explosion_queue_threshold', '=', None),
+            ('kit_explosion_queue_threshold', '>', 0),
+            ],
+        help="The number of kit lines created at once from which their "
+        "kits are exploded by the queue.\n"
+        "Leave empty to always explode them when they are created.")
+    kit_explosion_trigger = fields.Selection([
+            ('save', "On Save"),
+            ('quote', "On Quotation"),
+            ], "Kit Explosion Trigger", required=True,
+        help="When the kits of the draft sales are exploded.")
+
+    kit_lines_copy = fields.Selection([
+            ('explode', "Explode the Kits"),
+            ('update', "Copy and Update"),
+            ('keep', "Copy as They Are"),
+            ], "Kit Lines Copy", required=True,
+        help="How the kit lines are copied with their sale line:\n"
+        "- Explode the Kits: the kits are exploded again.\n"
+        "- Copy and Update: the kit lines are copied and their quantities "
+        "and prices updated.\n"
+        "- Copy as They Are: the kit lines are copied with their prices.")
+
+    kit_lines_invoice_grouped = fields.Boolean(
+        "Group Kit Lines in Invoices",
+        help="Add the kit lines without price to the description of the "
+        "invoice line of their priced kit instead of invoicing them.\n"
+        "Their stock moves are not linked to any invoice line so the cost "
+        "of goods sold of anglo-saxon accounting does not include them.")
+
+    @classmethod
+    def default_kit_explosion_trigger(cls):
+        return 'save'
+
+    @classmethod
+    def default_kit_lines_copy(cls):
+        return 'explode'
+
+
+class Sale(metaclass=PoolMeta):
+    __name__ = 'sale.sale'
+    kit_explosion_queued = fields.Boolean("Queue Kit Explosion",
+        states={
+            'readonly': Eval('state') != 'draft',
+            },
+        help="Explode the kits of the new lines by the queue.")
+
+    @classmethod
+    def default_kit_explosion_queued(cls):
+        return False
+
+    @classmethod
+    def quote(cls, sales):
+        cls.explode_deferred_kits(sales, 'quotation')
+        super().quote(sales)
+
+    @classmethod
+    def confirm(cls, sales):
+        cls.explode_deferred_kits(sales, 'confirmed')
+        super().confirm(sales)
+
+    @classmethod
+    def explode_deferred_kits(cls, sales, state=None):
+        '''
+        Explode at once the deferred kits of the sales, only of those that
+        can go to state if it is set.
+        '''
+        SaleLine = Pool().get('sale.line')
+
+        if state:
+            sales = [s for s in sales if (s.state, state) in cls._transitions]
+        lines = []
+        for sub_sales in grouped_slice(sales):
+            lines += SaleLine.search([
+                    ('sale', 'in', [s.id for s in sub_sales]),
+                    ('kit_explosion', '=', 'deferred'),
+                    ])
+        if lines:
+            SaleLine.explode_kit(lines)
+
+    def get_kit_invoice_groups(self):
+        '''
+        Return a dictionary with the kit lines without price grouped in the
+        invoice line of each priced root line and the set of their ids, if
+        the sale configuration says so. It is computed once for all the lines
+        of the sale and memoized for the transaction.
+        '''
+        Configuration = Pool().get('sale.configuration')
+
+        memo = transaction_memo('sale.sale.kit_invoice_groups')
+        if self.id not in memo:
+            groups = defaultdict(list)
+            if Configuration(1).kit_lines_invoice_grouped:
+                for line in self.lines:
+                    if (line.kit_root_line and not line.unit_price
+                            and line.kit_root_line.unit_price):
+                        groups[line.kit_root_line.id].append(line)
+            memo[self.id] = (dict(groups),
+                {line.id for line in chain(*groups.values())})
+        return memo[self.id]
+
+    @classmethod
+    def explode_kits(cls, sales):
+        '''
+        Explode at once the kits of the lines of the sales that are not
+        exploded yet, like those created with the explode_kit context set to
+        False by imports.
+        The kit plans, the default values of the lines and the prices of the
+        components are computed once for all the sales.
+        '''
+        SaleLine = Pool().get('sale.line')
+
+        lines = []
+        for sub_sales in grouped_slice(sales):
+            lines += SaleLine.search([
+                    ('sale', 'in', [s.id for s in sub_sales]),
+                    ('kit_parent_line', '=', None),
+                    ('product.kit', '=', True),
+                    ('product.explode_kit_in_sales', '=', True),
+                    ])
+        lines_kit_lines = SaleLine.get_lines_kit_lines(lines)
+        lines = [line for line in lines if not lines_kit_lines[line.id]]
+        if lines:
+            return SaleLine.explode_kit(lines)
+        return []
+
+    def check_for_quotation(self):
+        super().check_for_quotation()
+        if any(line.kit_explosion == 'queued' for line in self.lines):
+            raise SaleQuotationError(
+                gettext('sale_kit.kit_explosion_queued',
+                    sale=self.rec_name))
 
 
 class SaleLine(metaclass=PoolMeta):
@@ -17,19 +171,111 @@ class SaleLine(metaclass=PoolMeta):
         help='The kit that contains this product.')
     kit_child_lines = fields.One2Many('sale.line', 'kit_parent_line',
         'Lines in the kit', help='Subcomponents of the kit.')
+    kit_root_line = fields.Many2One('sale.line', 'Root Kit Line',
+        readonly=True, help='The top line of the kit that contains this '
+        'product.')
+    kit_sequence = fields.Integer('Kit Sequence', readonly=True,
+        help='Position of the line in the kit of its root line.')
+    kit_explosion = fields.Selection([
+            (None, ''),
+            ('queued', 'Queued'),
+            ('deferred', 'Deferred'),
+            ], 'Kit Explosion', readonly=True,
+        help='The explosion of the kit that is pending.')
+    kit_components = fields.Function(fields.Text('Kit Components',
+            states={
+                'invisible': ~Eval('kit_explosion'),
+                }),
+        'get_kit_components')
+    kit_buildable_quantity = fields.Function(fields.Float(
+            'Buildable Quantity', digits='unit',
+            states={
+                'invisible': Equal(Eval('kit_buildable_quantity', None), None),
+                }, help='The number of kits that can be assembled from the '
+            'stock of their components in the warehouse.'),
+        'get_kit_buildable_quantity')
+    kit_tree_lines = fields.Function(fields.One2Many('sale.line', None,
+            'Kit Tree Lines', help='The components of the kit one level '
+            'below the line.'),
+        'get_kit_tree_lines', setter='set_kit_tree_lines')
 
     @classmethod
     def __setup__(cls):
         super(SaleLine, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.kit_parent_line, Index.Equality()),
+                    where=t.kit_parent_line != Null),
+                Index(t,
+                    (t.kit_root_line, Index.Equality()),
+                    (t.kit_sequence, Index.Range()),
+                    where=t.kit_root_line != Null),
+                })
         required = (~(Eval('kit_parent_line', False))
             and (Equal(Eval('type'), 'line')))
         cls.unit_price.states['required'] = required
+        # Keep the kit lines after their root line of the same sequence
+        index = cls._order.index(('sequence', 'ASC NULLS FIRST')) + 1
+        cls._order[index:index] = [
+            ('kit_root_line', 'ASC'),
+            ('kit_sequence', 'ASC NULLS FIRST'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table_handler__(module_name)
+        sql_table = cls.__table__()
+        parent = cls.__table__()
+        line = cls.__table__()
+
+        fill_kit_root_line = not table.column_exist('kit_root_line')
+        fill_kit_sequence = not table.column_exist('kit_sequence')
+
+        super(SaleLine, cls).__register__(module_name)
+
+        # Fill the root of the kit lines level by level
+        while fill_kit_root_line:
+            cursor.execute(*sql_table.update(
+                    [sql_table.kit_root_line],
+                    [parent.select(Coalesce(parent.kit_root_line, parent.id),
+                            where=parent.id == sql_table.kit_parent_line)],
+                    where=(sql_table.kit_root_line == Null)
+                    & sql_table.kit_parent_line.in_(parent.select(parent.id,
+                            where=(parent.kit_parent_line == Null)
+                            | (parent.kit_root_line != Null)))))
+            fill_kit_root_line = cursor.rowcount > 0
+
+        # Number the kit lines of each root in their order, which is the
+        # depth-first order of the kit tree when they were exploded
+        if fill_kit_sequence:
+            positions = line.select(line.id.as_('id'),
+                RowNumber(window=Window([line.kit_root_line],
+                        order_by=[
+                            line.sequence.asc.nulls_first, line.id.asc])
+                    ).as_('kit_sequence'),
+                where=line.kit_root_line != Null)
+            cursor.execute(*sql_table.update(
+                    [sql_table.kit_sequence],
+                    [positions.select(positions.kit_sequence,
+                            where=positions.id == sql_table.id)],
+                    where=sql_table.kit_root_line != Null))
 
     @classmethod
     def default_kit_depth(cls):
         return 0
 
+    @staticmethod
+    def order_kit_root_line(tables):
+        table, _ = tables[None]
+        return [Coalesce(table.kit_root_line, table.id)]
+
     def _fill_line_from_kit_line(self, kit_line, line):
+        '''
+        Fill the line from the product.kit.line of the exploded line.
+        Deprecated: override _fill_line_from_kit_component instead, this
+        method is still called by it for compatibility.
+        '''
         pool = Pool()
         Product = pool.get('product.product')
         ProductUom = pool.get('product.uom')
@@ -48,7 +294,17 @@ class SaleLine(metaclass=PoolMeta):
         self.on_change_quantity()
         self.kit_parent_line = line
 
+    def _fill_line_from_kit_component(self, component, line, quantity):
+        "Fill the line from the KitComponent of the exploded line"
+        KitLine = Pool().get('product.kit.line')
+
+        self._fill_line_from_kit_line(KitLine(component.kit_line), line)
+        if self.quantity != quantity:
+            self.quantity = quantity
+            self.on_change_quantity()
+
     @classmethod
+    @profiled('sale.line.explode_kit')
     def explode_kit(cls, lines):
         '''
         Walks through the Kit tree in depth-first order and returns
@@ -57,77 +313,47 @@ class SaleLine(metaclass=PoolMeta):
         '''
         Product = Pool().get('product.product')
 
-        def max_sequence(sale_lines):
-            return max([sl.sequence for sl in sale_lines] +
-                [max_sequence(sl.kit_child_lines) for sl in sale_lines
-                    if sl.kit_child_lines])
-
         has_sale_discount = hasattr(cls, 'base_price')
 
-        sequence = lines[0].sequence if lines and lines[0].sequence else 1
-        to_write, to_create = [], []
+        factors, products = {}, {}
+        defaults = None
+        chunk_size = config.getint(
+            'sale_kit', 'explosion_chunk_size', default=1000)
+
+        to_write, components, new_lines = defaultdict(list), [], []
+        count = 0
+
+        def flush():
+            # Create the components and write the exploded lines so far to
+            # not keep all of them in memory. The components are priced
+            # before their kit price is reset as they get its discount.
+            if components:
+                new_lines.extend(cls._create_kit_components(components))
+                del components[:]
+            if to_write:
+                with phase('write'):
+                    # Call super write to not classify the kits again
+                    super(SaleLine, cls).write(*chain(*(
+                                (sub_lines, unfreeze(values))
+                                for values, sub_lines in to_write.items())))
+                to_write.clear()
+
         for line in lines:
-            if line.sequence != sequence and to_create:
-                line.sequence = sequence
-            sequence += 1
-            depth = line.kit_depth + 1
-            if (line.product and line.product.kit and line.product.kit_lines
-                    and line.product.explode_kit_in_sales):
-                kit_lines = line.product.kit_lines
-                kit_lines = list(zip(kit_lines, [depth] * len(list(kit_lines))))
-                while kit_lines:
-                    kit_line = kit_lines.pop(0)
-                    depth = kit_line[1]
-                    kit_line = kit_line[0]
-                    product = Product(kit_line.product)
-
-                    defualt_values = cls.default_get(cls._fields.keys(),
-                            with_rec_name=False)
-                    sale_line = cls(**defualt_values)
-                    # add party/sid when create new line with
-                    # sale_line_standalone or galatea_esale
-                    if hasattr(line, 'party'):
-                        sale_line.party = line.party
-                    if hasattr(line, 'sid'):
-                        sale_line.sid = line.sid
-                    sale_line.sale = line.sale
-                    sale_line._fill_line_from_kit_line(kit_line, line)
-                    sale_line.sequence = sequence
-                    sale_line.on_change_product()
-                    sale_line.kit_depth = depth
-
-                    if kit_line.get_sale_price():
-                        with Transaction().set_context(
-                                sale_line._get_context_sale_price()):
-                            prices = Product.get_sale_price(
-                                [product], line.quantity)
-                            unit_price = prices.get(product.id, Decimal(0))
-                            unit_price = round_price(unit_price)
-                    else:
-                        unit_price = Decimal(0)
-
-                    sale_line.unit_price = unit_price
-
-                    # Compatibility with sale_discount module
-                    if has_sale_discount:
-                        sale_line.base_price = unit_price
-                        sale_line.unit_price = unit_price
-                        if line.discount_rate is not None:
-                            sale_line.discount_rate = line.discount_rate
-                            sale_line.on_change_discount_rate()
-                        elif line.discount_amount is not None:
-                            sale_line.discount_amount = line.discount_amount
-                            sale_line.on_change_discount_amount()
-                    else:
-                        sale_line.unit_price = unit_price
-
-                    to_create.append(sale_line._save_values())
-                    if product.kit and product.kit_lines:
-                        product_kit_lines = product.kit_lines
-                        product_kit_lines = list(zip(product_kit_lines,
-                            [depth + 1] * len(list(product_kit_lines))))
-                        kit_lines = product_kit_lines + kit_lines
-                    sequence += 1
+            if line.kit_explosion:
+                line.kit_explosion = None
+            if line.product and line.product.kit_exploded_in_sales:
+                if defaults is None:
+                    defaults = cls._get_kit_component_defaults()
+                for kit_sequence, component in enumerate(
+                        line.product.get_kit_plan(), 1):
+                    sale_line = cls._get_kit_component_line(
+                        line, component, factors, defaults, products)
+                    # The components share the sequence of the kit and are
+                    # ordered by the kit_sequence after it
+                    sale_line.sequence = line.sequence
+                    sale_line.kit_sequence = kit_sequence
+                    components.append((sale_line, line, component))
+                    count += 1
                 if not line.product.kit_fixed_list_price and line.unit_price:
                     line.unit_price = Decimal(0)
             elif (line.product and line.product.kit_lines and
@@ -146,74 +372,829 @@ class SaleLine(metaclass=PoolMeta):
                     # Avoid modifing when not required
                     if line.unit_price != unit_price:
                         line.unit_price = unit_price
-            to_write.extend(([line], line._save_values()))
-        if to_write:
-            cls.write(*to_write)
+            values = line._save_values()
+            if values:
+                to_write[freeze(values)].append(line)
+            # Flush whole kits only so they are written with their components
+            if len(components) >= chunk_size:
+                flush()
+
+        flush()
+        cls._renumber_nested_kit_lines(lines)
+
+        profile = current_profile()
+        if profile and profile.name == 'sale.line.explode_kit':
+            profile.tags.update(
+                sales=sorted({line.sale.id for line in lines if line.sale}),
+                kits=sorted({line.product.id for line in lines
+                        if line.product
+                        and line.product.kit_exploded_in_sales}),
+                lines=len(lines),
+                components=count)
+        return new_lines
+
+    @classmethod
+    def _get_kit_component_line(cls, line, component, factors=None,
+            defaults=None, products=None):
+        '''
+        Return a new sale line for the component of the exploded line.
+        defaults are the default values of the sale lines if they are already
+        computed and products is a dictionary used to memoize the values set
+        by the on_change of each component product.
+        '''
+        if defaults is None:
+            defaults = cls._get_kit_component_defaults()
+        if products is None:
+            products = {}
+        party = getattr(line, 'party', None)
+        key = (line.sale.id if line.sale else None,
+            party.id if party else None, component.product, component.unit)
+        quantity = cls._get_kit_component_quantity(component, line, factors)
+        if key in products:
+            values = defaults.copy()
+            values.update(products[key])
+            sale_line = cls(**values)
+        else:
+            sale_line = cls(**defaults)
+        # add party/sid when create new line with
+        # sale_line_standalone or galatea_esale
+        if hasattr(line, 'party'):
+            sale_line.party = line.party
+        if hasattr(line, 'sid'):
+            sale_line.sid = line.sid
+        sale_line.sale = line.sale
+        if key in products:
+            sale_line.quantity = quantity
+            sale_line.kit_parent_line = line
+        else:
+            with phase('on_change_product'):
+                sale_line._fill_line_from_kit_component(
+                    component, line, quantity)
+                sale_line.on_change_product()
+            occurrence_fields = cls._get_kit_component_occurrence_fields()
+            products[key] = {name: value
+                for name, value in sale_line._default_values.items()
+                if name not in occurrence_fields}
+        sale_line.kit_depth = line.kit_depth + component.depth
+        sale_line.kit_root_line = line.kit_root_line or line
+        return sale_line
+
+    @classmethod
+    def _get_kit_component_occurrence_fields(cls):
+        '''
+        Return the fields of the new sale lines of components that depend on
+        each occurrence of the component and not only on its product and sale
+        '''
+        return {'id', 'sale', 'party', 'sid', 'quantity', 'unit_price',
+            'amount', 'base_price', 'discount_rate', 'discount_amount',
+            'discount', 'sequence', 'kit_parent_line', 'kit_root_line',
+            'kit_depth', 'kit_sequence'}
+
+    @classmethod
+    def _get_kit_component_defaults(cls):
+        "Return the default values of the new sale lines of components"
+        with phase('default_get'):
+            return cls.default_get(cls._fields.keys(), with_rec_name=False)
+
+    @classmethod
+    def _create_kit_components(cls, components):
+        '''
+        Price and create the new sale lines of the components.
+        components is a list of tuples of the new sale line, the exploded
+        line and the KitComponent.
+        '''
+        to_create = []
+        with phase('get_sale_price'):
+            prices = cls._get_kit_component_prices(components)
+        for (sale_line, line, _), unit_price in zip(components, prices):
+            sale_line._set_kit_component_price(line, unit_price)
+            to_create.append(sale_line._save_values())
         # Call super create to avoid recursion error
-        return super(SaleLine, cls).create(to_create)
+        with phase('create'):
+            return super(SaleLine, cls).create(to_create)
+
+    @classmethod
+    def _get_kit_component_quantity(cls, component, line, factors=None):
+        '''
+        Return the quantity of the component for the exploded line.
+        factors is a dictionary used to memoize the unit conversions.
+        '''
+        ProductUom = Pool().get('product.uom')
+
+        if factors is None:
+            factors = {}
+        key = (component.unit, component.quantity, line.unit.id)
+        if key not in factors:
+            if component.unit_category != line.unit.category.id:
+                factors[key] = component.quantity
+            else:
+                factors[key] = ProductUom.compute_qty(
+                    ProductUom(component.unit), component.quantity, line.unit)
+        return factors[key] * line.quantity
+
+    @classmethod
+    def _get_kit_component_prices(cls, components):
+        '''
+        Return the unit prices of the components to create.
+        components is a list of tuples of the new sale line, the exploded
+        line and the KitComponent. The products are priced in a single call
+        for each sale price context and quantity.
+        '''
+        Product = Pool().get('product.product')
+
+        groups = {}
+        keys = []
+        for sale_line, line, component in components:
+            key = None
+            if component.priced:
+                context = sale_line._get_context_sale_price()
+                key = (freeze(context), line.quantity)
+                groups.setdefault(key, (context, set()))[1].add(
+                    component.product)
+            keys.append(key)
+
+        prices = {}
+        for key, (context, product_ids) in groups.items():
+            _, quantity = key
+            with Transaction().set_context(context):
+                prices[key] = Product.get_sale_price(
+                    Product.browse(product_ids), quantity)
+
+        unit_prices = []
+        for (_, _, component), key in zip(components, keys):
+            if key is None:
+                unit_price = Decimal(0)
+            else:
+                unit_price = round_price(
+                    prices[key].get(component.product, Decimal(0)))
+            unit_prices.append(unit_price)
+        return unit_prices
+
+    def _set_kit_component_price(self, line, unit_price):
+        # Compatibility with sale_discount module
+        if hasattr(self, 'base_price'):
+            self.base_price = unit_price
+            self.unit_price = unit_price
+            if line.discount_rate is not None:
+                self.discount_rate = line.discount_rate
+                self.on_change_discount_rate()
+            elif line.discount_amount is not None:
+                self.discount_amount = line.discount_amount
+                self.on_change_discount_amount()
+        else:
+            self.unit_price = unit_price
 
     @classmethod
     def create(cls, values):
+        values = [v.copy() for v in values]
+        parents = cls.browse({v['kit_parent_line'] for v in values
+                if v.get('kit_parent_line') and not v.get('kit_root_line')})
+        roots = {p.id: (p.kit_root_line or p).id for p in parents}
+        for vals in values:
+            if (vals.get('kit_parent_line') in roots
+                    and not vals.get('kit_root_line')):
+                vals['kit_root_line'] = roots[vals['kit_parent_line']]
+        context = Transaction().context
+        explode = (context.get('explode_kit', True)
+            and not context.get('standalone', False))
+        if explode:
+            cls._set_kit_explosion(values)
         lines = super(SaleLine, cls).create(values)
-        if (Transaction().context.get('explode_kit', True)
-                and not Transaction().context.get('standalone', False)):
-            lines.extend(cls.explode_kit(lines))
+        if explode:
+            to_explode, queued = [], []
+            for line in lines:
+                if line.kit_explosion == 'queued':
+                    queued.append(line)
+                elif line.kit_explosion != 'deferred':
+                    to_explode.append(line)
+            if queued:
+                with Transaction().set_context(
+                        queue_batch=context.get('queue_batch', True)):
+                    cls.__queue__.explode_queued_kits(queued)
+            lines.extend(cls.explode_kit(to_explode))
         return lines
 
-    def get_kit_lines(self, kit_line=None):
-        res = []
-        if kit_line:
-            childs = kit_line.kit_child_lines
-        else:
-            childs = self.kit_child_lines
-        for kit_line in childs:
-            res.append(kit_line)
-            res += self.get_kit_lines(kit_line)
-        return res
+    @classmethod
+    def _set_kit_explosion(cls, values):
+        '''
+        Mark the values of the kits whose explosion is pending:
+        deferred until the quotation of the draft sales if the configuration
+        says so, or queued for the sales that queue their explosion or all of
+        them if there are more than the threshold of the configuration.
+        '''
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Product = pool.get('product.product')
+        Sale = pool.get('sale.sale')
+
+        products = {p.id: p for p in Product.browse(
+                {v['product'] for v in values if v.get('product')})}
+        kits = [v for v in values if v.get('product')
+            and products[v['product']].kit_exploded_in_sales]
+        if not kits:
+            return
+        config = Configuration(1)
+        threshold = config.kit_explosion_queue_threshold
+        sales = {s.id: s for s in Sale.browse(
+                {v['sale'] for v in kits if v.get('sale')})}
+        for vals in kits:
+            sale = sales.get(vals.get('sale'))
+            if (sale and sale.state == 'draft'
+                    and config.kit_explosion_trigger == 'quote'):
+                vals['kit_explosion'] = 'deferred'
+            elif ((threshold and len(kits) >= threshold)
+                    or (sale and sale.kit_explosion_queued)):
+                vals['kit_explosion'] = 'queued'
 
     @classmethod
-    def write(cls, *args):
-        actions = iter(args)
-        to_write, to_reset, to_delete = [], [], []
-        if (Transaction().context.get('explode_kit', True)
-                and not Transaction().context.get('standalone', False)):
-            for lines, values in zip(actions, actions):
-                reset_kit = False
-                # TODO Explode kit when add new line from standalone
-                if ('product' in values or 'quantity' in values
-                        or 'unit' in values):
-                    reset_kit = True
-                lines = lines[:]
-                if reset_kit:
-                    for line in lines:
-                        to_delete += line.get_kit_lines()
-                    lines = list(set(lines) - set(to_delete))
-                    to_reset.extend(lines)
-                to_write.extend((lines, values))
-        else:
-            to_write = args
+    def _defer_kit_explosion(cls, lines):
+        '''
+        Defer the explosion of the kits of the lines of draft sales if the
+        configuration says so and return the lines to explode now.
+        '''
+        Configuration = Pool().get('sale.configuration')
+
+        if not lines or Configuration(1).kit_explosion_trigger != 'quote':
+            return lines
+        to_explode, to_defer = [], []
+        for line in lines:
+            if (line.sale and line.sale.state == 'draft'
+                    and line.product and line.product.kit_exploded_in_sales):
+                if line.kit_explosion != 'deferred':
+                    to_defer.append(line)
+            else:
+                to_explode.append(line)
+        if to_defer:
+            # Call super write to not reset the kit lines
+            super(SaleLine, cls).write(to_defer, {
+                    'kit_explosion': 'deferred',
+                    })
+        return to_explode
+
+    @classmethod
+    def explode_queued_kits(cls, lines):
+        "Explode the kits of the lines that are still queued"
+        lines = cls.search([
+                ('id', 'in', [line.id for line in lines]),
+                ('kit_explosion', '=', 'queued'),
+                ])
+        if lines:
+            cls.explode_kit(lines)
+
+    @classmethod
+    def get_kit_components(cls, lines, name):
+        '''
+        Return the preview of the components of the kits whose explosion is
+        pending, one by line and indented by their depth.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        ProductUom = pool.get('product.uom')
+
+        factors = {}
+        previews = {}
+        for line in lines:
+            previews[line.id] = None
+            if (not line.kit_explosion or not line.unit
+                    or line.quantity is None or not line.product
+                    or not line.product.kit_exploded_in_sales):
+                continue
+            preview = []
+            for component in line.product.get_kit_plan():
+                preview.append('%s%s %s %s' % (
+                        '    ' * (component.depth - 1),
+                        cls._get_kit_component_quantity(
+                            component, line, factors),
+                        ProductUom(component.unit).symbol,
+                        Product(component.product).rec_name))
+            previews[line.id] = '\n'.join(preview)
+        return previews
+
+    @classmethod
+    def get_kit_buildable_quantity(cls, lines, name):
+        pool = Pool()
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+
+        result = {line.id: None for line in lines}
+        lines = [line for line in lines if line.product and line.product.kit
+            and line.warehouse and line.unit]
+        quantities = Product.get_kit_buildable_quantities(
+            list({line.product for line in lines}),
+            list({line.warehouse.id for line in lines}))
+        for line in lines:
+            quantity = quantities[(line.warehouse.id, line.product.id)]
+            if quantity is not None:
+                result[line.id] = Uom.compute_qty(line.product.default_uom,
+                    quantity, line.unit, round=False)
+        return result
+
+    @classmethod
+    def get_kit_tree_lines(cls, lines, name):
+        '''
+        Return the kit lines one level below each line.
+        Only the identifier, depth and position of the kit lines up to the
+        level below the deepest line are read, so expanding a kit in a tree
+        does not read all its components.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        result = {line.id: [] for line in lines}
+        roots = defaultdict(int)
+        for line in lines:
+            root = line.kit_root_line.id if line.kit_root_line else line.id
+            roots[root] = max(roots[root], line.kit_depth + 1)
+        for sub_roots in grouped_slice(roots):
+            sub_roots = list(sub_roots)
+            cursor.execute(*table.select(
+                    table.id, table.kit_parent_line, table.kit_root_line,
+                    table.kit_depth,
+                    where=table.kit_root_line.in_(sub_roots)
+                    & (table.kit_depth <= max(
+                            roots[root] for root in sub_roots)),
+                    order_by=[table.kit_root_line,
+                        table.kit_sequence.asc.nulls_first, table.id]))
+            # The last line of each depth of the kit being read
+            ancestors = {}
+            for line_id, parent, root, depth in cursor:
+                if depth > roots[root]:
+                    continue
+                if parent == root and (depth - 1) in ancestors.get(root, {}):
+                    # Components of nested kits are linked to their root
+                    parent = ancestors[root][depth - 1]
+                ancestors.setdefault(root, {})[depth] = line_id
+                if parent in result:
+                    result[parent].append(line_id)
+        return result
+
+    @classmethod
+    def set_kit_tree_lines(cls, lines, name, value):
+        "Write and delete the kit lines edited in the tree"
+        to_write, to_delete = [], []
+        for action in value or []:
+            if action[0] == 'write':
+                actions = iter(action[1:])
+                for ids, values in zip(actions, actions):
+                    to_write.extend((cls.browse(ids), values))
+            elif action[0] == 'delete':
+                to_delete.extend(cls.browse(action[1]))
+        if to_write:
+            cls.write(*to_write)
+        if to_delete:
+            cls.delete(to_delete)
+
+    @property
+    def zero_priced_kit_line(self):
+        '''
+        If the line is a kit line or an exploded kit without price whose
+        taxes compute no amount, so it does not change the amounts and taxes
+        of the sale.
+        '''
+        return bool(getattr(self, 'type', None) == 'line'
+            and getattr(self, 'unit_price', None) == 0
+            and (getattr(self, 'kit_parent_line', None)
+                or (getattr(self, 'product', None)
+                    and self.product.kit_exploded_in_sales))
+            and zero_base_taxes(getattr(self, 'taxes', None) or []))
+
+    @property
+    def taxable_lines(self):
+        if self.zero_priced_kit_line:
+            return []
+        return super().taxable_lines
+
+    def get_amount(self, name):
+        if self.zero_priced_kit_line:
+            return Decimal(0)
+        return super().get_amount(name)
+
+    def get_kit_lines(self):
+        return self.get_lines_kit_lines([self])[self.id]
+
+    @classmethod
+    def get_lines_kit_lines(cls, lines):
+        '''
+        Return a dictionary with the kit lines of each line in depth-first
+        order. All the lines of their kits are read in a single query.
+        '''
+        roots = {line.kit_root_line.id if line.kit_root_line else line.id
+            for line in lines}
+        children = defaultdict(list)
+        for sub_roots in grouped_slice(roots):
+            for kit_line in cls.search([
+                        ('kit_root_line', 'in', list(sub_roots)),
+                        ], order=[
+                        ('kit_sequence', 'ASC NULLS FIRST'),
+                        ('id', 'ASC'),
+                        ]):
+                if kit_line.kit_parent_line:
+                    children[kit_line.kit_parent_line.id].append(kit_line)
+
+        result = {}
+        for line in lines:
+            kit_lines = []
+            stack = list(reversed(children[line.id]))
+            while stack:
+                kit_line = stack.pop()
+                kit_lines.append(kit_line)
+                stack.extend(reversed(children[kit_line.id]))
+            result[line.id] = kit_lines
+        return result
+
+    @classmethod
+    def _match_kit_components(cls, line, kit_lines, plan):
+        '''
+        Match the components of the plan with the kit lines of the exploded
+        line by product and depth.
+        Return a list of (component, kit line) with None as kit line when
+        there is no match and the list of kit lines not matched.
+        '''
+        available = defaultdict(list)
+        for kit_line in kit_lines:
+            key = (kit_line.product.id if kit_line.product else None,
+                kit_line.kit_depth - line.kit_depth)
+            available[key].append(kit_line)
+        matches = []
+        for component in plan:
+            candidates = available.get((component.product, component.depth))
+            matches.append(
+                (component, candidates.pop(0) if candidates else None))
+        unmatched = list(chain(*available.values()))
+        return matches, unmatched
+
+    @classmethod
+    def reconcile_kit(cls, lines):
+        '''
+        Update the kit lines of the exploded lines after a change of their
+        product, quantity or unit to match their kit plan: only the missing
+        components are created, the extra kit lines deleted and the changed
+        quantities and prices written. The ids of the kept lines remain.
+        Return the lines that do not explode a kit.
+        '''
+        pool = Pool()
+        ProductUom = pool.get('product.uom')
+
+        lines = cls.browse(lines)
+        lines_kit_lines = cls.get_lines_kit_lines(lines)
+        to_explode, to_price, to_save, to_delete = [], [], [], []
+        components = []
+        factors, products = {}, {}
+        defaults = None
+        for line in lines:
+            if not (line.product and line.product.kit_exploded_in_sales):
+                to_explode.append(line)
+                continue
+            matches, unmatched = cls._match_kit_components(line,
+                lines_kit_lines[line.id], line.product.get_kit_plan())
+            to_delete.extend(unmatched)
+            for kit_sequence, (component, kit_line) in enumerate(matches, 1):
+                if kit_line is None:
+                    if defaults is None:
+                        defaults = cls._get_kit_component_defaults()
+                    kit_line = cls._get_kit_component_line(
+                        line, component, factors, defaults, products)
+                    kit_line.sequence = line.sequence
+                    kit_line.kit_sequence = kit_sequence
+                    components.append((kit_line, line, component))
+                    continue
+                if kit_line.sequence != line.sequence:
+                    kit_line.sequence = line.sequence
+                if kit_line.kit_sequence != kit_sequence:
+                    kit_line.kit_sequence = kit_sequence
+                quantity = cls._get_kit_component_quantity(
+                    component, line, factors)
+                if kit_line.quantity != quantity:
+                    kit_line.quantity = quantity
+                if (kit_line.unit.id != component.unit
+                        and kit_line.unit.category.id
+                        == component.unit_category):
+                    kit_line.unit = ProductUom(component.unit)
+                if component.priced:
+                    to_price.append((kit_line, line, component))
+                elif kit_line.unit_price:
+                    kit_line._set_kit_component_price(line, Decimal(0))
+                to_save.append(kit_line)
+            if not line.product.kit_fixed_list_price and line.unit_price:
+                line.unit_price = Decimal(0)
+            to_save.append(line)
+
+        prices = cls._get_kit_component_prices(to_price)
+        for (kit_line, line, _), unit_price in zip(to_price, prices):
+            kit_line._set_kit_component_price(line, unit_price)
+
+        to_write = defaultdict(list)
+        for line in to_save:
+            values = line._save_values()
+            if values:
+                to_write[freeze(values)].append(line)
         if to_write:
-            super(SaleLine, cls).write(*to_write)
-        super(SaleLine, cls).write(*args)
+            # Call super write to not reset the kit lines
+            super(SaleLine, cls).write(*chain(*(
+                        (lines, unfreeze(values))
+                        for values, lines in to_write.items())))
         if to_delete:
             cls.delete(to_delete)
-        to_reset = list(set(to_reset) - set(to_delete))
-        if to_reset:
-            cls.explode_kit(to_reset)
+        if components:
+            cls._create_kit_components(components)
+        cls._renumber_nested_kit_lines(lines)
+        return to_explode
+
+    @classmethod
+    def _classify_kit_writes(cls, args):
+        '''
+        Return a dictionary with the lines of the write actions classified by
+        what must be done with their kit lines once they are written:
+            explode: the lines without kit lines to explode
+            rescale: the exploded lines whose quantity or unit change
+            reconcile: the exploded lines whose product changes to a kit
+            delete: the kit lines of the exploded lines whose product is no
+                more a kit exploded in sales
+            sequence: the lines whose kit lines must follow their sequence
+            discount: the lines whose discount must be applied to their kit
+                lines
+        The kit lines written with their kit line are left to their kit.
+        '''
+        Product = Pool().get('product.product')
+
+        # Compatibility with sale_discount module
+        discount_fields = ({'unit_price', 'base_price', 'discount_rate',
+                'discount_amount'} if hasattr(cls, 'base_price') else set())
+        writes = defaultdict(list)
+        kit_lines = set()
+        actions = iter(args)
+        for lines, values in zip(actions, actions):
+            roots = [line for line in lines if not line.kit_parent_line]
+            if 'sequence' in values:
+                writes['sequence'].extend(roots)
+            if discount_fields & set(values):
+                writes['discount'].extend(roots)
+            # TODO Explode kit when add new line from standalone
+            if not {'product', 'quantity', 'unit'} & set(values):
+                continue
+            if 'product' not in values:
+                exploded = True
+            else:
+                exploded = bool(values['product']
+                    and Product(values['product']).kit_exploded_in_sales)
+            lines_kit_lines = cls.get_lines_kit_lines(lines)
+            for line in lines:
+                line_kit_lines = lines_kit_lines[line.id]
+                if not line_kit_lines:
+                    writes['explode'].append(line)
+                elif 'product' not in values:
+                    writes['rescale'].append(line)
+                elif exploded:
+                    writes['reconcile'].append(line)
+                else:
+                    writes['delete'].extend(line_kit_lines)
+                    writes['explode'].append(line)
+                kit_lines.update(line_kit_lines)
+        for key in ['explode', 'rescale', 'reconcile', 'sequence',
+                'discount']:
+            writes[key] = [line for line in dict.fromkeys(writes[key])
+                if line not in kit_lines]
+        return writes
+
+    @classmethod
+    @profiled('sale.line.write')
+    def write(cls, *args):
+        context = Transaction().context
+        if (not context.get('explode_kit', True)
+                or context.get('standalone', False)):
+            with phase('write'):
+                super(SaleLine, cls).write(*args)
+            cls._tag_write_profile(args)
+            return
+
+        writes = cls._classify_kit_writes(args)
+        discounts = {line.id: (line.discount_rate, line.discount_amount)
+            for line in cls.browse(writes['discount'])}
+        with phase('write'):
+            super(SaleLine, cls).write(*args)
+        cls._tag_write_profile(args)
+        if writes['sequence']:
+            cls._set_kit_lines_sequence(writes['sequence'])
+        to_reconcile = writes['rescale'] + writes['reconcile']
+        # Only the discounts that change are applied to the kit lines
+        to_discount = [line for line in cls.browse(
+                set(writes['discount']) - set(to_reconcile))
+            if (line.discount_rate, line.discount_amount)
+            != discounts[line.id]]
+        if to_discount:
+            with phase('discount'):
+                cls._set_kit_lines_discount(to_discount)
+        to_delete, to_explode = writes['delete'], writes['explode']
+        if to_reconcile:
+            with phase('reconcile'):
+                reconciled = cls.reconcile_kit(to_reconcile)
+                for line_kit_lines in cls.get_lines_kit_lines(
+                        reconciled).values():
+                    to_delete += line_kit_lines
+            to_explode += reconciled
+        if to_delete:
+            with phase('delete'):
+                cls.delete(to_delete)
+        deleted = set(to_delete)
+        to_explode = cls._defer_kit_explosion(
+            [line for line in to_explode if line not in deleted])
+        if to_explode:
+            with phase('explode'):
+                cls.explode_kit(to_explode)
+
+    @classmethod
+    def _tag_write_profile(cls, args):
+        "Tag the profile of the write with the sales and kits written"
+        profile = current_profile()
+        if not profile or profile.name != 'sale.line.write':
+            return
+        lines = cls.browse(set(chain(*args[::2])))
+        profile.tags.update(
+            sales=sorted({line.sale.id for line in lines if line.sale}),
+            kits=sorted({line.product.id for line in lines
+                    if line.product and line.product.kit}),
+            lines=len(lines))
+
+    @classmethod
+    def _set_kit_lines_sequence(cls, lines):
+        "Set the sequence of the lines to their kit lines"
+        to_write = defaultdict(list)
+        lines = cls.browse(lines)
+        lines_kit_lines = cls.get_lines_kit_lines(lines)
+        for line in lines:
+            for kit_line in lines_kit_lines[line.id]:
+                if kit_line.sequence != line.sequence:
+                    to_write[line.sequence].append(kit_line)
+        if to_write:
+            # Call super write to not reset the kit lines
+            super(SaleLine, cls).write(*chain(*(
+                        (kit_lines, {'sequence': sequence})
+                        for sequence, kit_lines in to_write.items())))
+
+    @classmethod
+    def _renumber_nested_kit_lines(cls, lines):
+        '''
+        Number again in the depth-first order of their kit the kit lines of
+        the roots of the lines that are kit lines exploding a kit, as their
+        components are numbered from 1.
+        '''
+        roots = {line.kit_root_line.id for line in lines
+            if line.kit_root_line and line.product
+            and line.product.kit_exploded_in_sales}
+        if not roots:
+            return
+        to_write = defaultdict(list)
+        for kit_lines in cls.get_lines_kit_lines(cls.browse(roots)).values():
+            for kit_sequence, kit_line in enumerate(kit_lines, 1):
+                if kit_line.kit_sequence != kit_sequence:
+                    to_write[kit_sequence].append(kit_line)
+        if to_write:
+            # Call super write to not reset the kit lines
+            super(SaleLine, cls).write(*chain(*(
+                        (kit_lines, {'kit_sequence': kit_sequence})
+                        for kit_sequence, kit_lines in to_write.items())))
+
+    @classmethod
+    def _set_kit_lines_discount(cls, lines):
+        '''
+        Apply the discount of the lines to the price of their kit lines
+        without exploding them again. The price of the kits without fixed
+        list price is reset as it is in their kit lines.
+        '''
+        lines = cls.browse(lines)
+        lines_kit_lines = cls.get_lines_kit_lines(lines)
+        to_write = defaultdict(list)
+        for line in lines:
+            for kit_line in lines_kit_lines[line.id]:
+                if kit_line.base_price is None:
+                    continue
+                unit_price = kit_line.unit_price
+                kit_line._set_kit_component_price(line, kit_line.base_price)
+                if kit_line.unit_price != unit_price:
+                    to_write[kit_line.unit_price].append(kit_line)
+            if (lines_kit_lines[line.id]
+                    and not line.product.kit_fixed_list_price
+                    and line.unit_price):
+                to_write[Decimal(0)].append(line)
+        if to_write:
+            # Call super write to not reset the kit lines
+            super(SaleLine, cls).write(*chain(*(
+                        (kit_lines, {'unit_price': unit_price})
+                        for unit_price, kit_lines in to_write.items())))
 
     @classmethod
     def copy(cls, lines, default=None):
+        Configuration = Pool().get('sale.configuration')
+
         if default is None:
             default = {}
         default['kit_child_lines'] = []
+        context = Transaction().context
         # third modules not check kit_parent_line to copy
-        if Transaction().context.get('check_kit_parent_line', True):
+        if context.get('check_kit_parent_line', True):
             lines = [x for x in lines if not x.kit_parent_line]
-        new_lines = super(SaleLine, cls).copy(lines, default=default)
-        return new_lines
+        kit_lines_copy = (context.get('kit_lines_copy')
+            or Configuration(1).kit_lines_copy)
+        if kit_lines_copy == 'explode':
+            return super(SaleLine, cls).copy(lines, default=default)
+
+        lines_kit_lines = cls.get_lines_kit_lines(lines)
+        kit_line_ids = {kit_line.id
+            for kit_line in chain(*lines_kit_lines.values())}
+        to_copy, to_clone = [], []
+        for line in lines:
+            if line.id in kit_line_ids:
+                continue
+            elif lines_kit_lines[line.id]:
+                to_clone.append(line)
+            else:
+                to_copy.append(line)
+        copies = dict(zip(to_copy,
+                super(SaleLine, cls).copy(to_copy, default=default)))
+        new_kit_lines = []
+        if to_clone:
+            with Transaction().set_context(explode_kit=False):
+                new_roots = super(SaleLine, cls).copy(
+                    to_clone, default=default)
+                new_kit_lines = cls._copy_kit_lines(
+                    to_clone, new_roots, lines_kit_lines, default)
+            if kit_lines_copy == 'update':
+                to_explode = cls.reconcile_kit(new_roots)
+                if to_explode:
+                    to_delete = list(chain(
+                            *cls.get_lines_kit_lines(to_explode).values()))
+                    cls.delete(to_delete)
+                    deleted = set(to_delete)
+                    new_kit_lines = [kit_line for kit_line in new_kit_lines
+                        if kit_line not in deleted]
+                    new_kit_lines += cls.explode_kit(to_explode)
+            copies.update(zip(to_clone, new_roots))
+        # The copies are returned in the order of the lines
+        return [copies[line] for line in lines if line in copies] + (
+            new_kit_lines)
+
+    @classmethod
+    def _copy_kit_lines(cls, lines, new_lines, lines_kit_lines, default):
+        '''
+        Copy the kit lines of the lines to their new lines without exploding
+        them again. The kit lines of each depth are copied at once.
+        '''
+        new_ids = {line.id: new_line.id
+            for line, new_line in zip(lines, new_lines)}
+        default = default.copy()
+        default['kit_parent_line'] = (
+            lambda data: new_ids[data['kit_parent_line']])
+        default['kit_root_line'] = (
+            lambda data: new_ids.get(data['kit_root_line']))
+        to_copy = list(chain(*(lines_kit_lines[line.id] for line in lines)))
+        new_kit_lines = []
+        while to_copy:
+            kit_lines = [kit_line for kit_line in to_copy
+                if kit_line.kit_parent_line.id in new_ids]
+            if not kit_lines:
+                break
+            copies = super(SaleLine, cls).copy(kit_lines, default=default)
+            new_ids.update((kit_line.id, copy.id)
+                for kit_line, copy in zip(kit_lines, copies))
+            new_kit_lines += copies
+            to_copy = [kit_line for kit_line in to_copy
+                if kit_line.id not in new_ids]
+        return new_kit_lines
 
     def get_invoice_line(self):
+        groups, grouped = (self.sale.get_kit_invoice_groups()
+            if self.sale else ({}, set()))
+        if self.id in grouped:
+            return []
         lines = super(SaleLine, self).get_invoice_line()
         for line in lines:
             line.sequence = self.sequence
+            if self.id in groups:
+                line.description = '\n'.join([line.description or '']
+                    + [self._get_kit_invoice_description(kit_line)
+                        for kit_line in groups[self.id]])
         return lines
+
+    @property
+    def _invoice_remaining_quantity(self):
+        '''
+        The kit lines grouped in the invoice line of their root line have no
+        invoice line of their own, so they follow the progress of the root.
+        '''
+        groups, grouped = (self.sale.get_kit_invoice_groups()
+            if self.sale else ({}, set()))
+        if self.id not in grouped:
+            return super(SaleLine, self)._invoice_remaining_quantity
+        root = self.kit_root_line
+        remaining = root._invoice_remaining_quantity
+        if remaining is None or not root.quantity:
+            return remaining
+        return self.quantity * remaining / root.quantity
+
+    def _get_kit_invoice_description(self, kit_line):
+        "Return the description of the kit line grouped in the invoice line"
+        return '%s%s %s %s' % (
+            '    ' * (kit_line.kit_depth - self.kit_depth - 1),
+            kit_line.quantity, kit_line.unit.symbol if kit_line.unit else '',
+            kit_line.description
+            or (kit_line.product.rec_name if kit_line.product else ''))
@@ -0,0 +1,214 @@
+# This file is part of sale_kit module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Benchmark of the kit explosion of sale_kit.
+
+It runs on the test database defined like for the test suite (DB_NAME and
+TRYTOND_DATABASE_URI environment variables, SQLite in memory by default):
+
+    python -m trytond.modules.sale_kit.tests.benchmark_sale_kit \\
+        --depth 2 --breadth 5 --lines 100
+
+It generates a kit tree of the given depth and breadth and a sibling kit
+sharing all but one of its components, then reports the wall time and the
+number of SQL queries of each operation on a sale of the given number of
+kit lines.
+'''
+import argparse
+import logging
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond.modules.account.tests import create_chart
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.sale_kit.tools import count_queries
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    CONTEXT, activate_module, with_transaction)
+from trytond.transaction import Transaction
+
+
+class Benchmark(object):
+
+    def __init__(self, depth, breadth, lines):
+        self.depth = depth
+        self.breadth = breadth
+        self.lines = lines
+        self.results = []
+
+    @contextmanager
+    def measure(self, name):
+        with count_queries() as counter:
+            start = time.perf_counter()
+            yield
+            duration = time.perf_counter() - start
+        self.results.append((name, duration, counter['queries']))
+
+    def setup(self):
+        pool = Pool()
+        Account = pool.get('account.account')
+        Category = pool.get('product.category')
+        Party = pool.get('party.party')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+        Uom = pool.get('product.uom')
+
+        self.company = company = create_company()
+        with set_company(company):
+            create_chart(company)
+            revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '!=', True),
+                    ], limit=1)
+            expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '!=', True),
+                    ], limit=1)
+            self.category = Category(name='Account Category',
+                accounting=True, account_revenue=revenue,
+                account_expense=expense)
+            self.category.save()
+            self.unit, = Uom.search([('name', '=', 'Unit')])
+            self.customer = Party(name='Customer', addresses=[{}])
+            self.customer.save()
+            self.payment_term = PaymentTerm(name='Direct',
+                lines=[{'type': 'remainder'}])
+            self.payment_term.save()
+
+    def create_product(self, name, kit_lines=None):
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+
+        template, = Template.create([{
+                    'name': name,
+                    'type': 'goods',
+                    'salable': True,
+                    'default_uom': self.unit.id,
+                    'sale_uom': self.unit.id,
+                    'list_price': Decimal(10),
+                    'account_category': self.category.id,
+                    'products': [('create', [{}])],
+                    }])
+        product, = template.products
+        if kit_lines:
+            Product.write([product], {
+                    'kit': True,
+                    'explode_kit_in_sales': True,
+                    'kit_lines': [('create', [{
+                                    'product': p.id,
+                                    'quantity': 1,
+                                    'unit': self.unit.id,
+                                    } for p in kit_lines])],
+                    })
+        return product
+
+    def create_kit(self, name, depth):
+        components = []
+        for i in range(self.breadth):
+            component_name = '%s.%s' % (name, i)
+            if depth > 1:
+                components.append(
+                    self.create_kit(component_name, depth - 1))
+            else:
+                components.append(self.create_product(component_name))
+        return self.create_product(name, components)
+
+    def create_sibling_kit(self, kit):
+        components = [line.product for line in kit.kit_lines][:-1]
+        components.append(self.create_product('%s.sibling' % kit.name))
+        return self.create_product('%s sibling' % kit.name, components)
+
+    def create_sale(self):
+        Sale = Pool().get('sale.sale')
+
+        sale = Sale(party=self.customer, payment_term=self.payment_term,
+            invoice_method='order')
+        sale.on_change_party()
+        sale.save()
+        return sale
+
+    def line_values(self, sale, product):
+        return [{
+                'sale': sale.id,
+                'type': 'line',
+                'product': product.id,
+                'quantity': 1,
+                'unit': self.unit.id,
+                'unit_price': Decimal(10),
+                'description': product.name,
+                'sequence': i,
+                } for i in range(1, self.lines + 1)]
+
+    def run(self):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Invoice = pool.get('account.invoice')
+
+        self.results = []
+        self.setup()
+        with set_company(self.company):
+            kit = self.create_kit('Kit', self.depth)
+            sibling = self.create_sibling_kit(kit)
+            tree_size = len(kit.get_kit_plan())
+
+            sale = self.create_sale()
+            with self.measure('create'):
+                lines = SaleLine.create(self.line_values(sale, kit))
+            top_lines = [line for line in lines if not line.kit_parent_line]
+
+            other_sale = self.create_sale()
+            with Transaction().set_context(explode_kit=False):
+                other_lines = SaleLine.create(
+                    self.line_values(other_sale, kit))
+            with self.measure('explode_kit'):
+                SaleLine.explode_kit(other_lines)
+
+            with self.measure('write quantity'):
+                SaleLine.write(top_lines, {'quantity': 2})
+            with self.measure('write product'):
+                SaleLine.write(top_lines, {'product': sibling.id})
+
+            with self.measure('copy'):
+                Sale.copy([sale])
+
+            sale = Sale(sale.id)
+            with self.measure('invoice'):
+                invoice = sale.create_invoice()
+                Invoice.save([invoice])
+
+        print('Kit tree of depth %s and breadth %s (%s components), '
+            'sale of %s lines' % (
+                self.depth, self.breadth, tree_size, self.lines))
+        print('%-16s %12s %10s' % ('Operation', 'Time (s)', 'Queries'))
+        for name, duration, queries in self.results:
+            print('%-16s %12.4f %10d' % (name, duration, queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the kit explosion of sale_kit")
+    parser.add_argument('--depth', type=int, default=2,
+        help="depth of the kit tree")
+    parser.add_argument('--breadth', type=int, default=5,
+        help="number of components of each kit")
+    parser.add_argument('--lines', type=int, default=50,
+        help="number of kit lines of the sale")
+    parser.add_argument('--profile', action='store_true',
+        help="log the profile of the kit operations")
+    args = parser.parse_args()
+
+    context = CONTEXT.copy()
+    if args.profile:
+        logging.basicConfig(level=logging.INFO)
+        context['sale_kit_profile'] = True
+    activate_module('sale_kit')
+    # Run it again on the transaction errors like the tests
+    benchmark = Benchmark(args.depth, args.breadth, args.lines)
+    with_transaction(context=context)(benchmark.run)()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,810 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from contextlib import contextmanager
+from decimal import Decimal
+from unittest.mock import PropertyMock, patch
+
+from trytond import config
+from trytond.model import ModelSQL
+from trytond.model.exceptions import RecursionError, ValidationError
+from trytond.modules.account.tests import create_chart
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.sale.exceptions import SaleQuotationError
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+@contextmanager
+def count_writes(model_name):
+    "Record the arguments of each SQL write of the model"
+    calls = []
+    write = ModelSQL.write.__func__
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+    def counted_write(cls, *args):
+        if cls.__name__ == model_name:
+            calls.append(args)
+        return write(cls, *args)
+
+    with patch.object(ModelSQL, 'write', classmethod(counted_write)):
+        yield calls
 
 
 class SaleKitTestCase(CompanyTestMixin, ModuleTestCase):
     'Test SaleKit module'
     module = 'sale_kit'
 
+    def create_account_category(self, name='Account Category', taxes=None):
+        "Create an accounting category with the customer taxes"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Category = pool.get('product.category')
+        Company = pool.get('company.company')
+
+        company = Company(Transaction().context['company'])
+        if not Account.search([('company', '=', company.id)], limit=1):
+            create_chart(company)
+        accounts = {}
+        for type_ in ['revenue', 'expense']:
+            accounts[type_], = Account.search([
+                    ('type.%s' % type_, '=', True),
+                    ('company', '=', company.id),
+                    ('closed', '!=', True),
+                    ], limit=1)
+        category, = Category.create([{
+                    'name': name,
+                    'accounting': True,
+                    'account_revenue': accounts['revenue'].id,
+                    'account_expense': accounts['expense'].id,
+                    'customer_taxes': [('add', [t.id for t in taxes or []])],
+                    }])
+        return category
+
+    def create_product(self, name, components=None, unit=None, **values):
+        "Create a salable product, a kit of the (product, quantity) if any"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Category = pool.get('product.category')
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+
+        if unit is None:
+            unit, = Uom.search([('name', '=', 'Unit')])
+        if 'account_category' not in values:
+            categories = Category.search([
+                    ('name', '=', 'Account Category'),
+                    ], limit=1)
+            category, = categories or [self.create_account_category()]
+            values['account_category'] = category.id
+        template_values = {
+            'name': name,
+            'type': 'goods',
+            'salable': True,
+            'default_uom': unit.id,
+            'sale_uom': unit.id,
+            'list_price': Decimal(10),
+            'products': [('create', [{}])],
+            }
+        template_values.update(values)
+        template, = Template.create([template_values])
+        product, = template.products
+        if components:
+            Product.write([product], {
+                    'kit': True,
+                    'explode_kit_in_sales': True,
+                    'kit_lines': [('create', [{
+                                    'product': component.id,
+                                    'quantity': quantity,
+                                    'unit': component.default_uom.id,
+                                    } for component, quantity in components])],
+                    })
+        return product
+
+    def create_sale(self, name='Customer'):
+        "Create a draft sale for a new customer"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+
+        customer = Party(name=name, addresses=[{}])
+        customer.save()
+        sale = Sale(party=customer)
+        sale.on_change_party()
+        sale.save()
+        return sale
+
+    def create_sale_line(self, sale, product, quantity=1, **values):
+        "Create a sale line of the product and explode its kit"
+        SaleLine = Pool().get('sale.line')
+
+        line_values = {
+            'sale': sale.id,
+            'type': 'line',
+            'product': product.id,
+            'quantity': quantity,
+            'unit': product.default_uom.id,
+            'unit_price': Decimal(10),
+            'description': product.name,
+            }
+        line_values.update(values)
+        return SaleLine.create([line_values])[0]
+
+    def create_kit_line(self):
+        "Create a sale line of a kit of two products"
+        component1 = self.create_product('Component 1')
+        component2 = self.create_product('Component 2')
+        kit = self.create_product('Kit', [(component1, 1), (component2, 1)])
+        return self.create_sale_line(self.create_sale(), kit), component1
+
+    @with_transaction()
+    def test_write_without_kit_change(self):
+        "Test a write that does not change the kit is done once"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            line, _ = self.create_kit_line()
+
+            with count_writes('sale.line') as calls:
+                SaleLine.write([line], {'description': 'Kit 1'})
+
+            self.assertEqual(len(calls), 1)
+
+    @with_transaction()
+    def test_write_kit_quantity(self):
+        "Test a change of quantity writes the line and its kit lines once"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            line, _ = self.create_kit_line()
+
+            with count_writes('sale.line') as calls:
+                SaleLine.write([line], {'quantity': 2})
+
+            self.assertEqual(len(calls), 2)
+            self.assertEqual([kit_line.quantity
+                    for kit_line in line.get_kit_lines()], [2, 2])
+
+    @with_transaction()
+    def test_write_kit_product(self):
+        "Test a change of product to a non kit deletes the kit lines"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            line, component = self.create_kit_line()
+
+            with count_writes('sale.line') as calls:
+                SaleLine.write([line], {'product': component.id})
+
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(line.get_kit_lines(), [])
+
+    @with_transaction()
+    def test_reconcile_kit_quantity(self):
+        "Test a change of quantity keeps the kit lines and rescales them"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            component1 = self.create_product('Component 1')
+            component2 = self.create_product('Component 2')
+            kit = self.create_product(
+                'Kit', [(component1, 1), (component2, 2)])
+            line = self.create_sale_line(self.create_sale(), kit)
+            kit_lines = line.get_kit_lines()
+
+            SaleLine.write([line], {'quantity': 3})
+
+            self.assertEqual(line.get_kit_lines(), kit_lines)
+            self.assertEqual(
+                [kit_line.quantity for kit_line in line.get_kit_lines()],
+                [3, 6])
+
+    @with_transaction()
+    def test_reconcile_kit_unit(self):
+        "Test a change of unit keeps the kit lines and rescales them"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        SaleLine = pool.get('sale.line')
+
+        kilogram, = Uom.search([('name', '=', 'Kilogram')])
+        gram, = Uom.search([('name', '=', 'Gram')])
+        company = create_company()
+        with set_company(company):
+            component = self.create_product('Component', unit=gram)
+            kit = self.create_product('Kit', [(component, 500)],
+                unit=kilogram)
+            sale = self.create_sale()
+            line = self.create_sale_line(sale, kit, 2)
+            kit_lines = line.get_kit_lines()
+
+            SaleLine.write([line], {'unit': gram.id, 'quantity': 2000})
+            exploded = self.create_sale_line(sale, kit, 2000, unit=gram.id)
+
+            self.assertEqual(line.get_kit_lines(), kit_lines)
+            self.assertEqual(
+                [(kit_line.quantity, kit_line.unit)
+                    for kit_line in line.get_kit_lines()],
+                [(kit_line.quantity, kit_line.unit)
+                    for kit_line in exploded.get_kit_lines()])
+
+    @with_transaction()
+    def test_reconcile_kit_sibling(self):
+        "Test a change to a kit sharing components keeps their kit lines"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            component1 = self.create_product('Component 1')
+            component2 = self.create_product('Component 2')
+            component3 = self.create_product('Component 3')
+            component4 = self.create_product('Component 4')
+            kit = self.create_product('Kit',
+                [(component1, 1), (component2, 1), (component3, 1)])
+            sibling = self.create_product('Sibling',
+                [(component1, 1), (component2, 2), (component4, 1)])
+            line = self.create_sale_line(self.create_sale(), kit, 2)
+            kit_line1, kit_line2, kit_line3 = line.get_kit_lines()
+
+            SaleLine.write([line], {'product': sibling.id})
+
+            kit_lines = line.get_kit_lines()
+            self.assertEqual(kit_lines[:2], [kit_line1, kit_line2])
+            self.assertNotIn(kit_line3, kit_lines)
+            self.assertEqual(SaleLine.search([('id', '=', kit_line3.id)]), [])
+            self.assertEqual(
+                [(kit_line.product, kit_line.quantity)
+                    for kit_line in kit_lines],
+                [(component1, 2), (component2, 4), (component4, 2)])
+
+    @with_transaction()
+    def test_reconcile_kit_not_kit(self):
+        "Test a change to a product that is not a kit deletes the kit lines"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            line, component = self.create_kit_line()
+            kit_lines = line.get_kit_lines()
+
+            SaleLine.write([line], {'product': component.id})
+
+            self.assertEqual(SaleLine.search([
+                        ('id', 'in', [kit_line.id for kit_line in kit_lines]),
+                        ]), [])
+            line = SaleLine(line.id)
+            self.assertEqual(line.product, component)
+            self.assertEqual(line.quantity, 1)
+            self.assertEqual(line.get_kit_lines(), [])
+
+    @with_transaction()
+    def test_kit_tree_lines(self):
+        "Test the kit tree lines are the components one level below"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            line, _ = self.create_kit_line()
+            kit_lines = line.get_kit_lines()
+
+            self.assertEqual(list(SaleLine(line.id).kit_tree_lines),
+                kit_lines)
+            self.assertEqual(
+                [list(kit_line.kit_tree_lines) for kit_line in kit_lines],
+                [[], []])
+
+            SaleLine.write([line], {
+                    'kit_tree_lines': [
+                        ('write', [kit_lines[0].id], {'sequence': 5})],
+                    })
+            self.assertEqual(SaleLine(kit_lines[0].id).sequence, 5)
+
+    @with_transaction()
+    def test_sale_price_memoized(self):
+        "Test the sale price is memoized until a record is written"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        company = create_company()
+        with set_company(company):
+            _, component = self.create_kit_line()
+
+            self.assertEqual(Product.get_sale_price([component]),
+                {component.id: Decimal(10)})
+            with patch.object(Product, '_get_sale_unit_price') as unit_price:
+                self.assertEqual(Product.get_sale_price([component]),
+                    {component.id: Decimal(10)})
+                unit_price.assert_not_called()
+
+            Template.write([component.template], {'list_price': Decimal(20)})
+            component = Product(component.id)
+            self.assertEqual(Product.get_sale_price([component]),
+                {component.id: Decimal(20)})
+
+    @with_transaction()
+    def test_queued_kit_explosion(self):
+        "Test the kits of large creations are exploded by the queue"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Queue = pool.get('ir.queue')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            configuration = Configuration(1)
+            configuration.kit_explosion_queue_threshold = 2
+            configuration.save()
+            component = self.create_product('Component')
+            kit = self.create_product('Kit', [(component, 1)])
+            sale = self.create_sale()
+
+            lines = SaleLine.create([{
+                        'sale': sale.id,
+                        'type': 'line',
+                        'product': kit.id,
+                        'quantity': 1,
+                        'unit': kit.default_uom.id,
+                        'unit_price': Decimal(10),
+                        'description': 'Kit',
+                        } for _ in range(2)])
+
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(
+                [line.kit_explosion for line in lines], ['queued', 'queued'])
+            with self.assertRaises(SaleQuotationError):
+                Sale.quote([sale])
+
+            for task in Queue.search([]):
+                task.run()
+
+            lines = SaleLine.browse(lines)
+            self.assertEqual(
+                [line.kit_explosion for line in lines], [None, None])
+            self.assertEqual(
+                [len(line.get_kit_lines()) for line in lines], [1, 1])
+            Sale.quote([sale])
+            self.assertEqual(Sale(sale.id).state, 'quotation')
+
+    @with_transaction()
+    def test_sale_kit_explosion_queued(self):
+        "Test the kits of a sale that queues their explosion are queued"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            component = self.create_product('Component')
+            kit = self.create_product('Kit', [(component, 1)])
+            sale = self.create_sale()
+            Sale.write([sale], {'kit_explosion_queued': True})
+
+            line = self.create_sale_line(sale, kit)
+
+            self.assertEqual(line.kit_explosion, 'queued')
+            self.assertEqual(line.get_kit_lines(), [])
+
+    @with_transaction()
+    def test_deferred_kit_explosion(self):
+        "Test the kits of draft sales are exploded on quotation"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            configuration = Configuration(1)
+            configuration.kit_explosion_trigger = 'quote'
+            configuration.save()
+            component = self.create_product('Component')
+            kit = self.create_product('Kit', [(component, 2)])
+            sale = self.create_sale()
+            line = self.create_sale_line(sale, kit)
+            SaleLine.write([line], {'quantity': 2})
+
+            line = SaleLine(line.id)
+            self.assertEqual(line.kit_explosion, 'deferred')
+            self.assertEqual(line.get_kit_lines(), [])
+            self.assertEqual(line.kit_components, '4.0 u Component')
+
+            # A draft sale can not be confirmed
+            Sale.confirm([sale])
+            self.assertEqual(SaleLine(line.id).kit_explosion, 'deferred')
+
+            Sale.quote([sale])
+            line = SaleLine(line.id)
+            self.assertEqual(line.kit_explosion, None)
+            self.assertEqual(line.kit_components, None)
+            self.assertEqual(
+                [kit_line.quantity for kit_line in line.get_kit_lines()], [4])
+
+    def copy_kit_line(self, kit_lines_copy):
+        "Copy a sale line of a kit whose first component quantity changed"
+        pool = Pool()
+        KitLine = pool.get('product.kit.line')
+        SaleLine = pool.get('sale.line')
+
+        line, _ = self.create_kit_line()
+        kit_line, _ = line.product.kit_lines
+        KitLine.write([kit_line], {'quantity': 2})
+        with Transaction().set_context(kit_lines_copy=kit_lines_copy):
+            new_line, *new_kit_lines = SaleLine.copy([line])
+        self.assertEqual(new_line.get_kit_lines(), new_kit_lines)
+        self.assertFalse(set(new_kit_lines) & set(line.get_kit_lines()))
+        return line, new_line
+
+    @with_transaction()
+    def test_copy_kit_lines_keep(self):
+        "Test copying the kit lines as they are"
+        company = create_company()
+        with set_company(company):
+            line, new_line = self.copy_kit_line('keep')
+
+            for kit_line, new_kit_line in zip(
+                    line.get_kit_lines(), new_line.get_kit_lines()):
+                self.assertEqual(new_kit_line.product, kit_line.product)
+                self.assertEqual(new_kit_line.quantity, kit_line.quantity)
+                self.assertEqual(new_kit_line.kit_parent_line, new_line)
+                self.assertEqual(new_kit_line.kit_root_line, new_line)
+                self.assertEqual(
+                    new_kit_line.kit_sequence, kit_line.kit_sequence)
+            self.assertEqual([kit_line.quantity
+                    for kit_line in new_line.get_kit_lines()], [1, 1])
+
+    @with_transaction()
+    def test_copy_kit_lines_update(self):
+        "Test copying the kit lines and updating them to their kit"
+        company = create_company()
+        with set_company(company):
+            line, new_line = self.copy_kit_line('update')
+
+            self.assertEqual([kit_line.quantity
+                    for kit_line in line.get_kit_lines()], [1, 1])
+            self.assertEqual([
+                    (kit_line.quantity, kit_line.kit_parent_line,
+                        kit_line.kit_root_line)
+                    for kit_line in new_line.get_kit_lines()], [
+                    (2, new_line, new_line),
+                    (1, new_line, new_line),
+                    ])
+
+    @with_transaction()
+    def test_copy_kit_lines_order(self):
+        "Test the copies of the lines are returned in their order"
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            line, component = self.create_kit_line()
+            plain_line = self.create_sale_line(line.sale, component)
+            for kit_lines_copy in ['keep', 'update']:
+                with Transaction().set_context(
+                        kit_lines_copy=kit_lines_copy):
+                    new_plain_line, new_line, *new_kit_lines = (
+                        SaleLine.copy([plain_line, line]))
+                self.assertEqual(new_plain_line.product, component)
+                self.assertEqual(new_line.product, line.product)
+                self.assertEqual(new_line.get_kit_lines(), new_kit_lines)
+
+    @with_transaction()
+    def test_kit_buildable_quantities(self):
+        "Test the buildable quantity of a nested kit with unit conversion"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        KitLine = pool.get('product.kit.line')
+
+        kilogram, = Uom.search([('name', '=', 'Kilogram')])
+        gram, = Uom.search([('name', '=', 'Gram')])
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+        warehouse, = Location.search([('code', '=', 'WH')])
+
+        company = create_company()
+        with set_company(company):
+            component1 = self.create_product('Component 1', unit=kilogram)
+            component2 = self.create_product('Component 2')
+            sub_kit = self.create_product('Sub Kit', [(component2, 3)])
+            kit = self.create_product('Kit',
+                [(sub_kit, 2), (component1, 500)])
+            kit_line, = [kit_line for kit_line in kit.kit_lines
+                if kit_line.product == component1]
+            KitLine.write([kit_line], {'unit': gram.id})
+
+            moves = Move.create([{
+                        'product': product.id,
+                        'unit': product.default_uom.id,
+                        'quantity': quantity,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        'company': company.id,
+                        } for product, quantity in [
+                        (component1, 2), (component2, 30)]])
+            Move.do(moves)
+
+            # 2 kg of 500 g per kit and 30 units of 3 * 2 per kit
+            self.assertEqual(Product.get_kit_buildable_quantities(
+                    [kit, sub_kit], [warehouse.id]), {
+                    (warehouse.id, kit.id): 4,
+                    (warehouse.id, sub_kit.id): 10,
+                    })
+
+    @with_transaction()
+    def test_zero_priced_kit_lines_amounts(self):
+        "Test skipping the kit lines without price keeps the sale amounts"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Tax = pool.get('account.tax')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            self.create_account_category()
+            tax_account, = Account.search([('code', '=', '6.3.6')])
+            percentage, fixed = Tax.create([{
+                        'name': 'Percentage',
+                        'description': 'Percentage',
+                        'type': 'percentage',
+                        'rate': Decimal('0.1'),
+                        'invoice_account': tax_account.id,
+                        'credit_note_account': tax_account.id,
+                        }, {
+                        'name': 'Fixed',
+                        'description': 'Fixed',
+                        'type': 'fixed',
+                        'amount': Decimal(1),
+                        'invoice_account': tax_account.id,
+                        'credit_note_account': tax_account.id,
+                        }])
+            percentage_category = self.create_account_category(
+                'Percentage', [percentage])
+            fixed_category = self.create_account_category('Fixed', [fixed])
+            component1 = self.create_product('Component 1',
+                account_category=percentage_category.id)
+            component2 = self.create_product('Component 2',
+                account_category=fixed_category.id)
+            kit = self.create_product('Kit',
+                [(component1, 1), (component2, 1)],
+                account_category=percentage_category.id)
+            sale = self.create_sale()
+            line = self.create_sale_line(sale, kit, 2,
+                taxes=[('add', [percentage.id])])
+            kit_line1, kit_line2 = line.get_kit_lines()
+            self.assertEqual(
+                [kit_line1.unit_price, kit_line2.unit_price], [0, 0])
+            self.assertEqual([
+                    kit_line1.zero_priced_kit_line,
+                    kit_line2.zero_priced_kit_line,
+                    ], [True, False])
+
+            names = ['untaxed_amount', 'tax_amount', 'total_amount']
+            amounts = Sale.get_amount([sale], names)
+            with patch.object(SaleLine, 'zero_priced_kit_line',
+                    new_callable=PropertyMock, return_value=False):
+                self.assertEqual(Sale.get_amount([sale], names), amounts)
+            self.assertEqual(amounts, {
+                    'untaxed_amount': {sale.id: Decimal('20.00')},
+                    'tax_amount': {sale.id: Decimal('4.00')},
+                    'total_amount': {sale.id: Decimal('24.00')},
+                    })
+
+    @with_transaction()
+    def test_sale_explode_kits(self):
+        "Test exploding the kits of many sales at once"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            component1 = self.create_product('Component 1')
+            component2 = self.create_product('Component 2')
+            kit1 = self.create_product('Kit 1',
+                [(component1, 1), (component2, 2)])
+            kit2 = self.create_product('Kit 2',
+                [(component2, 3), (component1, 1)])
+            Product.write([kit2], {'kit_fixed_list_price': False})
+
+            def create_sales():
+                sales = [self.create_sale('Customer 1'),
+                    self.create_sale('Customer 2')]
+                with Transaction().set_context(explode_kit=False):
+                    for sale in sales:
+                        self.create_sale_line(sale, kit1, 2)
+                        self.create_sale_line(sale, kit2, 3)
+                return sales
+
+            def get_lines(sale):
+                return [(line.product, line.quantity, line.unit_price,
+                        line.kit_depth, line.kit_sequence)
+                    for line in Sale(sale.id).lines]
+
+            sales = create_sales()
+            self.assertEqual(len(Sale.explode_kits(sales)), 8)
+            others = create_sales()
+            for sale in others:
+                SaleLine.explode_kit(list(Sale(sale.id).lines))
+
+            for sale, other in zip(sales, others):
+                self.assertEqual(len(get_lines(sale)), 6)
+                self.assertEqual(get_lines(sale), get_lines(other))
+            self.assertEqual(Sale.explode_kits(sales), [])
+
+    @with_transaction()
+    def test_nested_kit_sequence(self):
+        "Test a kit line exploding a kit keeps its components after it"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            component1 = self.create_product('Component 1')
+            component2 = self.create_product('Component 2')
+            component3 = self.create_product('Component 3')
+            sub_kit = self.create_product('Sub Kit', [(component1, 1)])
+            other_kit = self.create_product('Other Kit', [(component3, 1)])
+            kit = self.create_product('Kit', [(sub_kit, 1), (component2, 1)])
+            line = self.create_sale_line(self.create_sale(), kit)
+            kit_line, = [kit_line for kit_line in line.get_kit_lines()
+                if kit_line.product == component1]
+            SaleLine.write([kit_line], {'product': other_kit.id})
+
+            lines = Sale(line.sale.id).lines
+            self.assertEqual([sale_line.product for sale_line in lines],
+                [kit, sub_kit, other_kit, component3, component2])
+            self.assertEqual([sale_line.kit_sequence for sale_line in lines],
+                [None, 1, 2, 3, 4])
+
+    @with_transaction()
+    def test_kit_rollup_prices(self):
+        "Test the sale price of the kits not exploded is their components'"
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Product = pool.get('product.product')
+        KitLine = pool.get('product.kit.line')
+
+        kilogram, = Uom.search([('name', '=', 'Kilogram')])
+        gram, = Uom.search([('name', '=', 'Gram')])
+
+        company = create_company()
+        with set_company(company):
+            component1 = self.create_product('Component 1')
+            component2 = self.create_product('Component 2', unit=kilogram,
+                list_price=Decimal(20))
+            sub_kit = self.create_product('Sub Kit', [(component1, 2)])
+            kit1 = self.create_product('Kit 1',
+                [(sub_kit, 1), (component2, 500)])
+            kit2 = self.create_product('Kit 2',
+                [(sub_kit, 2), (component1, 1)])
+            Product.write([sub_kit, kit1, kit2], {
+                    'explode_kit_in_sales': False,
+                    'kit_fixed_list_price': False,
+                    })
+            kit_line, = [kit_line for kit_line in kit1.kit_lines
+                if kit_line.product == component2]
+            KitLine.write([kit_line], {'unit': gram.id})
+
+            # Sub Kit: 2 * 10, Kit 1: 20 + 500 g * 20 / kg,
+            # Kit 2: 2 * 20 + 10
+            self.assertEqual(
+                Product.get_sale_price([sub_kit, kit1, kit2]), {
+                    sub_kit.id: Decimal(20),
+                    kit1.id: Decimal(30),
+                    kit2.id: Decimal(50),
+                    })
+
+    @with_transaction()
+    def test_kit_rollup_prices_recursion(self):
+        "Test the sale price of a kit containing itself raises an error"
+        pool = Pool()
+        Product = pool.get('product.product')
+        KitLine = pool.get('product.kit.line')
+
+        company = create_company()
+        with set_company(company):
+            component = self.create_product('Component')
+            kit1 = self.create_product('Kit 1', [(component, 1)])
+            kit2 = self.create_product('Kit 2', [(kit1, 1)])
+            Product.write([kit1, kit2], {
+                    'explode_kit_in_sales': False,
+                    'kit_fixed_list_price': False,
+                    })
+            kit1 = Product(kit1.id)
+            kit1.kit_lines += (KitLine(
+                    product=kit2, quantity=1, unit=kit2.default_uom),)
+
+            with self.assertRaises(RecursionError):
+                Product._get_kit_rollup_prices(
+                    [kit1], Product._get_kit_price_converter())
+
+    @with_transaction()
+    def test_explode_kit_chunks(self):
+        "Test exploding the kits by chunks gives the same lines"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            component1 = self.create_product('Component 1')
+            component2 = self.create_product('Component 2')
+            kit = self.create_product('Kit',
+                [(component1, 1), (component2, 2)])
+            Product.write([kit], {'kit_fixed_list_price': False})
+
+            def explode():
+                sale = self.create_sale()
+                with Transaction().set_context(explode_kit=False):
+                    lines = [self.create_sale_line(sale, kit, sequence=i)
+                        for i in range(1, 4)]
+
+                def get_values(line):
+                    return (line.product, line.quantity, line.unit_price,
+                        line.sequence, line.kit_depth, line.kit_sequence,
+                        line.kit_parent_line.sequence
+                        if line.kit_parent_line else None)
+                with patch.object(SaleLine, '_create_kit_components',
+                        wraps=SaleLine._create_kit_components) as create:
+                    new_lines = SaleLine.explode_kit(lines)
+                return (create.call_count,
+                    [get_values(line) for line in new_lines],
+                    [get_values(line) for line in Sale(sale.id).lines])
+
+            calls, new_lines, lines = explode()
+            self.assertEqual(calls, 1)
+            self.assertEqual(len(new_lines), 6)
+            self.assertEqual(
+                [line[2] for line in lines if not line[4]], [0, 0, 0])
+
+            previous = config.get('sale_kit', 'explosion_chunk_size')
+            if not config.has_section('sale_kit'):
+                config.add_section('sale_kit')
+            config.set('sale_kit', 'explosion_chunk_size', '3')
+            self.addCleanup(config.set, 'sale_kit', 'explosion_chunk_size',
+                previous or '1000')
+            # The chunks end with the kit whose components reach the size
+            self.assertEqual(explode(), (2, new_lines, lines))
+
+    @with_transaction()
+    def test_required_salable_products_in_kits(self):
+        "Test the components of the kits exploded in sales must be salable"
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        company = create_company()
+        with set_company(company):
+            component = self.create_product('Component')
+            kit = self.create_product('Kit', [(component, 1)])
+            Product.write([kit], {'explode_kit_in_sales': False})
+            Template.write([component.template], {'salable': False})
+            kit_line, = kit.kit_lines
+            kit.check_required_salable_products_in_kits()
+            kit_line.check_required_salable_lines()
+
+            with self.assertRaises(ValidationError):
+                Product.write([kit], {'explode_kit_in_sales': True})
+
 
 del ModuleTestCase
@@ -188,3 +188,64 @@ class Test(unittest.TestCase):
         self.assertEqual(line3.unit_price, Decimal('0.0'))
         self.assertEqual(line4.unit_price, Decimal('0.0'))
         self.assertEqual(line4.unit_price, Decimal('0.0'))
+
+        # Sale a kit priced by its components
+        template = ProductTemplate()
+        template.name = 'kit'
+        template.default_uom = unit
+        template.type = 'goods'
+        template.salable = True
+        template.list_price = Decimal('10')
+        template.cost_price_method = 'fixed'
+        template.account_category = account_category
+        kit, = template.products
+        kit.cost_price = Decimal('5')
+        kit.kit = True
+        kit.explode_kit_in_sales = True
+        kit.kit_fixed_list_price = False
+        template.save()
+        kit, = template.products
+        for component in [pkit1, pkit2]:
+            kit_line = ProductKitLine()
+            kit.kit_lines.append(kit_line)
+            kit_line.product = component
+            kit_line.quantity = 1
+        kit.save()
+
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'order'
+        sale_line = SaleLine()
+        sale.lines.append(sale_line)
+        sale_line.product = kit
+        sale_line.quantity = 2.0
+        sale_line.discount_rate = Decimal('0.1')
+        self.assertEqual(sale_line.base_price, Decimal('10.0000'))
+        self.assertEqual(sale_line.unit_price, Decimal('9.0000'))
+        sale.save()
+        sale.click('quote')
+        self.assertEqual(len(sale.lines), 3)
+
+        line1, line2, line3 = sale.lines
+        self.assertEqual(line1.unit_price, Decimal('0.0'))
+        self.assertEqual(line2.base_price, Decimal('10.0000'))
+        self.assertEqual(line2.unit_price, Decimal('9.0000'))
+        self.assertEqual(line3.base_price, Decimal('10.0000'))
+        self.assertEqual(line3.unit_price, Decimal('9.0000'))
+        self.assertEqual(sale.untaxed_amount, Decimal('36.00'))
+
+        # Change the discount of the kit without exploding it again
+        sale.click('draft')
+        line1, line2, line3 = sale.lines
+        component_ids = [line2.id, line3.id]
+        line1.discount_rate = Decimal('0.2')
+        self.assertEqual(line1.unit_price, Decimal('8.0000'))
+        line1.save()
+        sale.reload()
+        line1, line2, line3 = sale.lines
+        self.assertEqual([line2.id, line3.id], component_ids)
+        self.assertEqual(line1.unit_price, Decimal('0.0'))
+        self.assertEqual(line2.unit_price, Decimal('8.0000'))
+        self.assertEqual(line3.unit_price, Decimal('8.0000'))
+        self.assertEqual(sale.untaxed_amount, Decimal('32.00'))
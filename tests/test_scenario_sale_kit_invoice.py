@@ -0,0 +1,164 @@
+import unittest
+from decimal import Decimal
+
+from proteus import Model
+from trytond.modules.account.tests.tools import (create_chart,
+                                                 create_fiscalyear, create_tax,
+                                                 get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    create_payment_term, set_fiscalyear_invoice_sequences)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.tests.test_tryton import drop_db
+from trytond.tests.tools import activate_modules
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        drop_db()
+        super().setUp()
+
+    def tearDown(self):
+        drop_db()
+        super().tearDown()
+
+    def test(self):
+
+        # Install sale_kit
+        activate_modules('sale_kit')
+
+        # Create company
+        _ = create_company()
+        company = get_company()
+
+        # Create fiscal year
+        fiscalyear = set_fiscalyear_invoice_sequences(
+            create_fiscalyear(company))
+        fiscalyear.click('create_period')
+
+        # Create chart of accounts
+        _ = create_chart(company)
+        accounts = get_accounts(company)
+        revenue = accounts['revenue']
+        expense = accounts['expense']
+        cash = accounts['cash']
+
+        # Create payment method
+        Journal = Model.get('account.journal')
+        PaymentMethod = Model.get('account.invoice.payment.method')
+        cash_journal, = Journal.find([('type', '=', 'cash')])
+        payment_method = PaymentMethod()
+        payment_method.name = 'Cash'
+        payment_method.journal = cash_journal
+        payment_method.credit_account = cash
+        payment_method.debit_account = cash
+        payment_method.save()
+
+        # Create tax
+        tax = create_tax(Decimal('.10'))
+        tax.save()
+
+        # Group the kit lines in invoices
+        Configuration = Model.get('sale.configuration')
+        configuration = Configuration(1)
+        configuration.kit_lines_invoice_grouped = True
+        configuration.save()
+
+        # Create party
+        Party = Model.get('party.party')
+        customer = Party(name='Customer')
+        customer.save()
+
+        # Create account category
+        ProductCategory = Model.get('product.category')
+        account_category = ProductCategory(name="Account Category")
+        account_category.accounting = True
+        account_category.account_expense = expense
+        account_category.account_revenue = revenue
+        account_category.customer_taxes.append(tax)
+        account_category.save()
+
+        # Create kit with two components
+        ProductUom = Model.get('product.uom')
+        unit, = ProductUom.find([('name', '=', 'Unit')])
+        ProductTemplate = Model.get('product.template')
+        ProductKitLine = Model.get('product.kit.line')
+        components = []
+        for name in ['Component 1', 'Component 2']:
+            template = ProductTemplate()
+            template.name = name
+            template.default_uom = unit
+            template.type = 'goods'
+            template.salable = True
+            template.list_price = Decimal('10')
+            template.account_category = account_category
+            template.save()
+            component, = template.products
+            components.append(component)
+        template = ProductTemplate()
+        template.name = 'Kit'
+        template.default_uom = unit
+        template.type = 'goods'
+        template.salable = True
+        template.list_price = Decimal('30')
+        template.account_category = account_category
+        kit, = template.products
+        kit.kit = True
+        kit.explode_kit_in_sales = True
+        kit.kit_fixed_list_price = True
+        template.save()
+        kit, = template.products
+        for component in components:
+            kit_line = ProductKitLine()
+            kit.kit_lines.append(kit_line)
+            kit_line.product = component
+            kit_line.quantity = 1
+        kit.save()
+
+        # Create payment term
+        payment_term = create_payment_term()
+        payment_term.save()
+
+        # Sale the kit
+        Sale = Model.get('sale.sale')
+        SaleLine = Model.get('sale.line')
+        sale = Sale()
+        sale.party = customer
+        sale.payment_term = payment_term
+        sale.invoice_method = 'order'
+        sale_line = SaleLine()
+        sale.lines.append(sale_line)
+        sale_line.product = kit
+        sale_line.quantity = 2.0
+        sale.click('quote')
+        self.assertEqual(len(sale.lines), 3)
+        sale.click('confirm')
+        self.assertEqual(sale.state, 'processing')
+
+        # The kit lines are grouped in the invoice line of the kit
+        invoice, = sale.invoices
+        invoice_line, = invoice.lines
+        self.assertEqual(invoice_line.product, kit)
+        self.assertIn('Component 1', invoice_line.description)
+        self.assertIn('Component 2', invoice_line.description)
+        self.assertEqual(invoice.untaxed_amount, Decimal('60.00'))
+
+        # Pay the invoice
+        invoice.click('post')
+        pay = invoice.click('pay')
+        pay.form.payment_method = payment_method
+        pay.execute('choice')
+        invoice.reload()
+        self.assertEqual(invoice.state, 'paid')
+
+        # All the lines are invoiced
+        sale.reload()
+        self.assertEqual(sale.invoice_state, 'paid')
+        self.assertEqual(
+            [line.invoice_progress for line in sale.lines], [1, 1, 1])
+
+        # A second invoicing run creates no invoice
+        sale.click('process')
+        sale.reload()
+        self.assertEqual(len(sale.invoices), 1)
+        self.assertEqual(sale.invoice_state, 'paid')
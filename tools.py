@@ -0,0 +1,195 @@
+# This file is part of sale_kit module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from weakref import WeakKeyDictionary
+
+from trytond import backend, config
+from trytond.transaction import Transaction
+
+logger = logging.getLogger('trytond.modules.sale_kit.profile')
+_memos = WeakKeyDictionary()
+_local = threading.local()
+_cursor_classes = {}
+
+
+def transaction_memo(name):
+    '''
+    Return a dictionary to memoize values under name for the current
+    transaction. It is emptied as soon as a record is created, written or
+    deleted in the transaction.
+    '''
+    transaction = Transaction()
+    counter, memos = _memos.get(transaction, (None, None))
+    if counter != transaction.counter:
+        memos = {}
+        _memos[transaction] = (transaction.counter, memos)
+    return memos.setdefault(name, {})
+
+
+def zero_base_taxes(taxes):
+    '''
+    Return if the taxes compute no amount on a zero base, which is the case
+    when they and their children are all percentages.
+    The result is memoized for the transaction.
+    '''
+    memo = transaction_memo('account.tax.zero_base')
+    key = tuple(sorted(map(int, taxes)))
+    if key not in memo:
+        memo[key] = all(tax.type in {'percentage', 'none'}
+            and zero_base_taxes(tax.childs) for tax in taxes)
+    return memo[key]
+
+
+def _count_query(*args):
+    for counter in getattr(_local, 'counters', ()):
+        counter['queries'] += 1
+
+
+def _trace_query(query):
+    _count_query()
+    sqlite_logger = logging.getLogger('trytond.backend.sqlite.database')
+    if sqlite_logger.isEnabledFor(logging.DEBUG):
+        sqlite_logger.debug(query)
+
+
+def _counting_cursor(base):
+    "Return a subclass of the cursor class base that counts its queries"
+    if base not in _cursor_classes:
+        class CountingCursor(base):
+            def execute(self, query, vars=None):
+                _count_query()
+                return super().execute(query, vars)
+        _cursor_classes[base] = CountingCursor
+    return _cursor_classes[base]
+
+
+@contextmanager
+def count_queries():
+    '''
+    Count the SQL queries executed in the block on the connection of the
+    transaction. The queries of the other connections are not counted.
+    '''
+    if not getattr(_local, 'counters', None):
+        _local.counters = []
+    counters = _local.counters
+    counter = {'queries': 0}
+    if not counters:
+        connection = Transaction().connection
+        if backend.name == 'sqlite':
+            connection.set_trace_callback(_trace_query)
+        else:
+            cursor_factory = connection.cursor_factory
+            if cursor_factory is None:
+                from psycopg2.extensions import cursor as cursor_factory
+            connection.cursor_factory = _counting_cursor(cursor_factory)
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+        if not counters:
+            if backend.name == 'sqlite':
+                sqlite_logger = logging.getLogger(
+                    'trytond.backend.sqlite.database')
+                connection.set_trace_callback(
+                    sqlite_logger.debug
+                    if sqlite_logger.isEnabledFor(logging.DEBUG) else None)
+            else:
+                connection.cursor_factory = cursor_factory
+
+
+class Profile(object):
+    "The time and SQL queries of the phases of an operation"
+
+    def __init__(self, name):
+        self.name = name
+        self.tags = {}
+        self.phases = {}
+        self.duration = 0
+        self.queries = 0
+
+    def add(self, phase, duration, queries):
+        calls, total_duration, total_queries = self.phases.get(
+            phase, (0, 0, 0))
+        self.phases[phase] = (
+            calls + 1, total_duration + duration, total_queries + queries)
+
+    def log(self):
+        def format_tag(name, value):
+            if isinstance(value, (list, tuple, set)):
+                value = ','.join(map(str, value))
+            return '%s=%s' % (name, value)
+
+        logger.info('%s %s: %.4fs %s queries; %s', self.name,
+            ' '.join(format_tag(*t) for t in sorted(self.tags.items())),
+            self.duration, self.queries,
+            ', '.join('%s: %s calls %.4fs %s queries' % (p, c, d, q)
+                for p, (c, d, q) in self.phases.items()))
+
+
+def profiling():
+    '''
+    Return if the kit operations must be profiled, with the sale_kit_profile
+    key of the context or the profile option of the sale_kit section of the
+    configuration.
+    '''
+    context = Transaction().context
+    if 'sale_kit_profile' in context:
+        return bool(context['sale_kit_profile'])
+    return config.getboolean('sale_kit', 'profile', default=False)
+
+
+def current_profile():
+    "Return the innermost running profile or None"
+    profiles = getattr(_local, 'profiles', None)
+    return profiles[-1] if profiles else None
+
+
+def profiled(name):
+    '''
+    Decorate a method to log its profile when profiling is activated.
+    The recursive calls are included in the profile of the outermost call.
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = current_profile()
+            if ((profile and profile.name == name)
+                    or not profiling()):
+                return func(*args, **kwargs)
+            if not getattr(_local, 'profiles', None):
+                _local.profiles = []
+            profile = Profile(name)
+            _local.profiles.append(profile)
+            try:
+                with count_queries() as counter:
+                    start = time.perf_counter()
+                    result = func(*args, **kwargs)
+                    profile.duration = time.perf_counter() - start
+                    profile.queries = counter['queries']
+            finally:
+                _local.profiles.pop()
+            profile.log()
+            return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def phase(name):
+    "Record the time and SQL queries of the block in the current profile"
+    profile = current_profile()
+    if not profile:
+        yield
+        return
+    with count_queries() as counter:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.add(name, time.perf_counter() - start, counter['queries'])